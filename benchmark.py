@@ -0,0 +1,406 @@
+import os
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import threading
+import resource
+import tracemalloc
+import multiprocessing
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# offline benchmark of the LLM stages: a local OpenAI-compatible mock server
+# answers every request with canned output after a configurable latency, the
+# stages run on synthetic papers and papers/sec, request latency percentiles
+# and peak memory are reported per stage
+
+benchmark_stage_list = ["review", "logical_flow", "experiment", "task_technique"]
+
+section_heading_list = [
+    "Abstract", "1 Introduction", "2 Related Work", "3 Method", "4 Experiments",
+    "5 Conclusion", "Limitations", "References", "Appendix"
+]
+filler_word_list = (
+    "the model method results training data performance network layer attention baseline "
+    "benchmark dataset accuracy loss proposed approach learning feature representation task"
+).split()
+
+
+def generate_papers(paper_dir, paper_num, paragraph_num=4, paragraph_words=80, seed=0):
+    # synthetic papers in the structure/data format: data maps paragraph ids
+    # to text, structure maps (sub)headings to the ids of their paragraphs
+    rng = random.Random(seed)
+    os.makedirs(paper_dir, exist_ok=True)
+    for paper_idx in range(paper_num):
+        data = {}
+        structure = {"Title": f"p{paper_idx}_title"}
+        data[f"p{paper_idx}_title"] = " ".join(rng.choices(filler_word_list, k=8))
+        for heading_idx, heading in enumerate(section_heading_list):
+            paragraph_ids = []
+            for paragraph_idx in range(rng.randint(1, paragraph_num)):
+                paragraph_id = f"p{paper_idx}_{heading_idx}_{paragraph_idx}"
+                data[paragraph_id] = " ".join(rng.choices(filler_word_list, k=paragraph_words))
+                paragraph_ids.append(paragraph_id)
+            if rng.random() < 0.3:
+                structure[heading] = {f"{heading_idx}.1 Details": paragraph_ids}
+            else:
+                structure[heading] = paragraph_ids
+        with open(os.path.join(paper_dir, f"paper{paper_idx:05d}.json"), 'w', encoding='utf-8') as f:
+            json.dump({"structure": structure, "data": data}, f)
+
+
+def first_json_value(text):
+    match = re.search(r'[\[{]', text)
+    if match is None:
+        return None
+    try:
+        return json.JSONDecoder().raw_decode(text[match.start():])[0]
+    except json.JSONDecodeError:
+        return None
+
+def make_malformed(answer):
+    # the usual LLM json mistakes that util.repair_json has to fix
+    return answer.replace('"', "'").replace("]", ",]", 1)
+
+def canned_answer(system_prompt, user_content, malformed=False):
+    framework = "1. Firstly, the section introduces the problem. 2. Then, it presents the approach. 3. Finally, it summarizes the findings."
+    if "every key of the input json" in system_prompt:
+        keys = list((first_json_value(user_content) or {}).keys())
+        blocks = [json.dumps({key: framework for key in keys})]
+    elif "writing framework" in system_prompt:
+        return f"```string\n{framework}\n```\nThe framework above keeps only the compositional pattern."
+    elif "Remove duplicates" in system_prompt:
+        blocks = [json.dumps([framework, "1. The section states the goal. 2. It ends with the outcome."])]
+    elif "one object per input text" in system_prompt:
+        keys = list((first_json_value(user_content) or {}).keys())
+        blocks = [json.dumps([{
+            "key": key,
+            "experiment_types": ["ablation study"],
+            "baselines": [random.choice(["ResNet-50", "ViT-B/16", "BERT-base"])],
+            "benchmarks": ["ImageNet"],
+            "metrics": ["accuracy"]
+        } for key in keys])]
+    elif "experiment types" in system_prompt:
+        blocks = [json.dumps({
+            "experiment_types": ["ablation study", "hyperparameter tuning"],
+            "baselines": [random.choice(["ResNet-50", "ViT-B/16", "BERT-base"])],
+            "benchmarks": ["ImageNet"],
+            "metrics": ["accuracy"]
+        })]
+    elif "task name" in system_prompt:
+        blocks = [
+            json.dumps({"name": random.choice(["Image Classification", "image classification", "Object Detection"]),
+                        "description": ["assign a label to an image"], "challenges": ["label noise"],
+                        "latent_techniques": ["data augmentation"]}),
+            json.dumps({"name": random.choice(["Vision Transformer (ViT)", "ViT", "ResNet"]),
+                        "description": ["attention based image encoder"], "advantages": ["scales well"],
+                        "disadvantages": ["needs much data"], "targeted_tasks": ["image classification"],
+                        "project_urls": []}),
+        ]
+    elif "invalid input json" in system_prompt:
+        return "```json\n{}\n```"
+    else:
+        # structure review: answer with the input structure unchanged
+        blocks = [json.dumps(first_json_value(user_content) or {})]
+    if malformed:
+        blocks = [make_malformed(block) for block in blocks]
+    return "\n\n".join(f"```json\n{block}\n```" for block in blocks) + "\nThe output follows the requested format."
+
+
+class MockHTTPServer(ThreadingHTTPServer):
+    # the default listen backlog of 5 drops the connections of a burst of
+    # concurrent requests, their retransmits would show up as 1s latencies
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+class MockLLMServer:
+    # OpenAI-compatible /chat/completions endpoint, latency is drawn uniformly
+    # from latency * (1 +- jitter), error_rate of the requests fail with
+    # error_status and malformed_rate of the answers hold malformed json
+    def __init__(self, latency=0.2, jitter=0.5, error_rate=0.0, error_status=500, malformed_rate=0.0, seed=0,
+                 host="127.0.0.1", port=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.malformed_rate = malformed_rate
+        self.rng = random.Random(seed)
+        self.rng_lock = threading.Lock()
+        self.request_num = 0
+        self.server = MockHTTPServer((host, port), self.make_handler())
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def draw(self):
+        with self.rng_lock:
+            self.request_num += 1
+            latency = self.latency * self.rng.uniform(1 - self.jitter, 1 + self.jitter)
+            return max(latency, 0.0), self.rng.random() < self.error_rate, self.rng.random() < self.malformed_rate
+
+    def make_handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, status, body, headers=()):
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for key, value in headers:
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                latency, error, malformed = mock.draw()
+                time.sleep(latency)
+                if error:
+                    headers = [("Retry-After", "1")] if mock.error_status == 429 else []
+                    self.send_json(mock.error_status, {"error": {"message": "mock error", "type": "server_error"}}, headers)
+                    return
+                messages = request.get('messages', [])
+                system_prompt = messages[0]['content'] if messages else ""
+                user_content = messages[-1]['content'] if messages else ""
+                content = canned_answer(system_prompt, user_content, malformed)
+                prompt_tokens = sum(len(message['content']) for message in messages) // 4
+                usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(content) // 4,
+                         "total_tokens": prompt_tokens + len(content) // 4}
+                if request.get('stream'):
+                    self.send_stream(request['model'], content)
+                    return
+                self.send_json(200, {
+                    "id": f"mock-{mock.request_num}", "object": "chat.completion", "created": int(time.time()),
+                    "model": request['model'], "usage": usage,
+                    "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}]
+                })
+
+            def send_stream(self, model, content):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                self.close_connection = True
+                try:
+                    for idx in range(0, len(content), 16):
+                        chunk = {"id": "mock-stream", "object": "chat.completion.chunk", "created": int(time.time()),
+                                 "model": model, "choices": [{"index": 0, "delta": {"content": content[idx:idx + 16]}, "finish_reason": None}]}
+                        self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+                        self.wfile.flush()
+                    self.wfile.write(b"data: [DONE]\n\n")
+                    self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client closed the stream once it had its code blocks
+                    pass
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def serve_mock(connection, server_kwargs):
+    mock_server = MockLLMServer(**server_kwargs)
+    connection.send(mock_server.base_url)
+    mock_server.server.serve_forever()
+
+def start_mock_process(**server_kwargs):
+    # the mock server gets a process of its own, in the benchmark process its
+    # threads would compete with the stages for the GIL and inflate latencies
+    parent_connection, child_connection = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=serve_mock, args=(child_connection, server_kwargs), daemon=True)
+    process.start()
+    return process, parent_connection.recv()
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(int(q * len(sorted_values)), len(sorted_values) - 1)]
+
+def stage_report(stage, paper_num, elapsed, samples, traced_peak=None, error=None):
+    latencies = sorted(latency for latency, _ in samples)
+    return {
+        "stage": stage,
+        "papers": paper_num,
+        "seconds": round(elapsed, 3),
+        "papers_per_sec": round(paper_num / elapsed, 2) if elapsed > 0 else None,
+        "requests": len(samples),
+        "request_errors": sum(1 for _, failed in samples if failed),
+        "p50_latency": round(percentile(latencies, 0.5), 4) if latencies else None,
+        "p99_latency": round(percentile(latencies, 0.99), 4) if latencies else None,
+        # the peak resident size of the process so far, it never decreases between stages
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2),
+        "peak_traced_mb": round(traced_peak / (1 << 20), 2) if traced_peak is not None else None,
+        "error": error,
+    }
+
+def print_reports(reports):
+    print(f"{'stage':<16}{'papers/s':>10}{'requests':>10}{'errors':>8}{'p50 s':>9}{'p99 s':>9}{'rss MB':>10}{'traced MB':>11}")
+    for report in reports:
+        print(f"{report['stage']:<16}{report['papers_per_sec'] or 0:>10.2f}{report['requests']:>10}{report['request_errors']:>8}"
+              f"{report['p50_latency'] or 0:>9.3f}{report['p99_latency'] or 0:>9.3f}{report['peak_rss_mb']:>10.2f}"
+              f"{report['peak_traced_mb'] if report['peak_traced_mb'] is not None else '-':>11}"
+              + (f"  failed: {report['error']}" if report['error'] else ""))
+
+def run_benchmark(args):
+    work_dir = os.path.abspath(args.work_dir or tempfile.mkdtemp(prefix="llm_benchmark_"))
+    paper_dir = os.path.join(work_dir, "papers")
+    generate_papers(paper_dir, args.papers, seed=args.seed)
+
+    mock_process, mock_base_url = start_mock_process(
+        latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        error_status=args.error_status, malformed_rate=args.malformed_rate, seed=args.seed
+    )
+    config_path = os.path.join(work_dir, "llm_config.json")
+    with open(config_path, 'w', encoding='utf-8') as f:
+        json.dump([
+            {"api_key": "mock", "base_url": mock_base_url, "model": f"mock-{idx}", "rpm": args.rpm, "tpm": args.tpm}
+            for idx in range(args.endpoints)
+        ], f)
+    # util reads these when it is first imported, the stages write their outputs below work_dir
+    os.environ["LLM_CONFIG_PATH"] = config_path
+    os.environ["LLM_CACHE_DISABLE"] = "1"
+    os.environ.setdefault("LLM_METRICS_DIR", os.path.join(work_dir, "metrics"))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(work_dir)
+
+    import util
+    import pipeline
+    from metrics import CallMetrics
+    from corpus import compile_corpus
+
+    class SampledCallMetrics(CallMetrics):
+        # also keeps every (latency, failed) sample for exact percentiles
+        def __init__(self):
+            super().__init__()
+            self.samples = []
+
+        def record_call(self, name, latency, usage=None, error=None):
+            super().record_call(name, latency, usage, error)
+            with self.lock:
+                self.samples.append((latency, error is not None))
+
+    util.call_metrics = SampledCallMetrics()
+    if args.stream:
+        util.client.set_streaming(True)
+        util.async_client.set_streaming(True)
+    if args.hedge:
+        util.client.set_hedging(True)
+        util.async_client.set_hedging(True)
+    if args.concurrency is not None:
+        util.async_client.set_max_concurrency(args.concurrency)
+
+    corpus = compile_corpus(paper_dir)
+    reports = []
+    if args.trace_memory:
+        tracemalloc.start()
+
+    def start_stage():
+        util.call_metrics.samples = []
+        if args.trace_memory:
+            tracemalloc.reset_peak()
+        return time.perf_counter()
+
+    def finish_stage(stage, start_time, error):
+        elapsed = time.perf_counter() - start_time
+        traced_peak = tracemalloc.get_traced_memory()[1] if args.trace_memory else None
+        reports.append(stage_report(stage, args.papers, elapsed, util.call_metrics.samples, traced_peak, error))
+
+    async def async_run_stages():
+        # one event loop for all stages, the async clients are bound to the loop they first ran on
+        for stage in args.stages:
+            start_time = start_stage()
+            error = None
+            try:
+                await pipeline.async_timed_stage(stage, corpus, args)
+            except Exception as exc:
+                error = f"{type(exc).__name__}: {exc}"
+            finish_stage(stage, start_time, error)
+
+    try:
+        if args.async_mode:
+            asyncio.run(async_run_stages())
+        else:
+            for stage in args.stages:
+                start_time = start_stage()
+                error = None
+                try:
+                    pipeline.timed_stage(stage, corpus, args)
+                except Exception as exc:
+                    error = f"{type(exc).__name__}: {exc}"
+                finish_stage(stage, start_time, error)
+    finally:
+        if args.trace_memory:
+            tracemalloc.stop()
+        corpus.close()
+        mock_process.terminate()
+
+    print_reports(reports)
+    benchmark_result = {"settings": {key: value for key, value in vars(args).items()}, "stages": reports}
+    output_path = args.output or os.path.join(work_dir, "benchmark.json")
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(benchmark_result, f, indent=4)
+    print(f"benchmark report written to {output_path}")
+    return reports
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the LLM stages offline against a local mock chat-completions server.")
+    parser.add_argument("--papers", type=int, default=200, help="Number of synthetic papers")
+    parser.add_argument("--stages", type=str, default=",".join(benchmark_stage_list), help="Comma separated stages to benchmark, in this order")
+    parser.add_argument("--latency", type=float, default=0.2, help="Mean latency in seconds of a mock response")
+    parser.add_argument("--jitter", type=float, default=0.5, help="Latency is drawn uniformly from latency * (1 +- jitter)")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="Fraction of the requests failing")
+    parser.add_argument("--error_status", type=int, default=500, help="HTTP status of a failing request, 429 also sends Retry-After")
+    parser.add_argument("--malformed_rate", type=float, default=0.0, help="Fraction of the answers holding malformed json")
+    parser.add_argument("--endpoints", type=int, default=2, help="Number of endpoints in the config list, all served by the mock server")
+    parser.add_argument("--rpm", type=int, default=None, help="Requests per minute quota of every mock endpoint, enforced by the client's rate governor")
+    parser.add_argument("--tpm", type=int, default=None, help="Tokens per minute quota of every mock endpoint, enforced by the client's rate governor")
+    parser.add_argument("--async_mode", action="store_true", help="Run the stages on the asyncio client instead of thread pools")
+    parser.add_argument("--concurrency", type=int, default=None, help="Max requests in flight per endpoint in async mode")
+    parser.add_argument("--stream", action="store_true", help="Stream completions and stop reading once the expected code blocks are closed")
+    parser.add_argument("--hedge", action="store_true", help="Send a duplicate of a request slower than the recent p95 to another endpoint")
+    parser.add_argument("--pack_tokens", type=int, default=0, help="Pack several sections into one logical flow or experiment request up to this many input tokens")
+    parser.add_argument("--fan_in", type=int, default=16, help="Number of frameworks fused per request at each level of the fusion tree")
+    parser.add_argument("--dedup_threshold", type=float, default=None, help="Consolidate near-duplicate tasks and techniques at this MinHash similarity")
+    parser.add_argument("--trace_memory", action="store_true", help="Also report the peak memory traced by tracemalloc per stage, this slows the stages down")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic papers and of the mock server")
+    parser.add_argument("--work_dir", type=str, default=None, help="Directory for the papers and stage outputs, a new temporary directory by default")
+    parser.add_argument("--output", type=str, default=None, help="Path of the json report, <work_dir>/benchmark.json by default")
+    args = parser.parse_args()
+    if args.fan_in < 2:
+        parser.error(f"--fan_in must be at least 2, got {args.fan_in}")
+
+    args.stages = [stage.strip() for stage in args.stages.split(",") if stage.strip()]
+    unknown = [stage for stage in args.stages if stage not in benchmark_stage_list]
+    if unknown:
+        print(f"Error: unknown stages {', '.join(unknown)}, choose from {', '.join(benchmark_stage_list)}.")
+        sys.exit(1)
+    # options of the pipeline stages that have no meaning here
+    args.resume = False
+    if args.output:
+        args.output = os.path.abspath(args.output)
+    run_benchmark(args)
+
+if __name__ == "__main__":
+    main()
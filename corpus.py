@@ -0,0 +1,190 @@
+import os
+import json
+import hashlib
+import sqlite3
+import threading
+from journal import file_hash
+from sharding import in_shard, shard_suffix
+
+section_name_list = [
+    "title",
+    "abstract",
+    "introduction",
+    "related work",
+    "experiment",
+    "conclusion",
+    "limitation",
+    "reference",
+    "appendix",
+    "checklist",
+    "image",
+    "table",
+]
+
+def concatenate_values(structure):
+    result = []
+    if isinstance(structure, str):
+        result.append(structure)
+    if isinstance(structure, list):
+        if len(structure) != 0:
+            for v in structure:
+                result.append(concatenate_values(v))
+    if isinstance(structure, dict):
+        if len(structure.values()) != 0:
+            for v in structure.values():
+                result.append(concatenate_values(v))
+    result = [item for item in result if item is not None]
+    return "\n".join(result)
+
+def extract_sections(json_data):
+    global section_name_list
+    new_json_data = dict()
+    for key in json_data['structure'].keys():
+        for sn in section_name_list:
+            if sn in key.lower():
+                new_json_data[sn] = concatenate_values(json_data['structure'][key])
+    empty_key_list = []
+    for key in new_json_data.keys():
+        value_idx_list = new_json_data[key].split("\n")
+        value_list = []
+        for idx in value_idx_list:
+            if idx != "":
+                value_list.append(json_data['data'][idx])
+        new_json_data[key] = "\n".join(value_list)
+        if new_json_data[key] == "":
+            empty_key_list.append(key)
+    for key in empty_key_list:
+        new_json_data.pop(key)
+    if "related work" in new_json_data.keys():
+        new_json_data['related_work'] = new_json_data['related work']
+        new_json_data.pop("related work")
+    return new_json_data
+
+def read_structure_data(json_path):
+    with open(json_path, encoding='utf-8') as f:
+        json_data = json.load(f)
+    return extract_sections(json_data)
+
+
+class Corpus:
+    # SQLite index over a json_dir holding, per paper, its content hash, raw
+    # structure, full text and the section texts from extract_sections.
+    # refresh() only re-parses files whose mtime/size and then hash changed.
+    # With shard=(i, N) only the files of that shard (see sharding.py) are indexed.
+    def __init__(self, json_dir, db_path=None, shard=None):
+        self.json_dir = json_dir
+        self.shard = shard
+        if db_path is None:
+            dir_key = hashlib.sha1(os.path.abspath(json_dir).encode('utf-8')).hexdigest()[:16]
+            if shard is not None:
+                dir_key = f"{dir_key}.{shard_suffix(shard)}"
+            db_path = os.path.join("./corpus", f"{dir_key}.sqlite")
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS papers (
+                file_name TEXT PRIMARY KEY,
+                mtime REAL,
+                size INTEGER,
+                hash TEXT,
+                structure TEXT,
+                text TEXT
+            );
+            CREATE TABLE IF NOT EXISTS sections (
+                file_name TEXT,
+                section TEXT,
+                text TEXT,
+                PRIMARY KEY (file_name, section)
+            );
+        ''')
+
+    def refresh(self):
+        with self.lock:
+            known = {
+                row[0]: row[1:]
+                for row in self.conn.execute("SELECT file_name, mtime, size, hash FROM papers")
+            }
+            seen = set()
+            updated_num = 0
+            for file_name in os.listdir(self.json_dir):
+                file_path = os.path.join(self.json_dir, file_name)
+                if not in_shard(file_name, self.shard) or not os.path.isfile(file_path):
+                    continue
+                stat = os.stat(file_path)
+                previous = known.get(file_name)
+                if previous is not None and previous[0] == stat.st_mtime and previous[1] == stat.st_size:
+                    seen.add(file_name)
+                    continue
+                content_hash = file_hash(file_path)
+                if previous is not None and previous[2] == content_hash:
+                    self.conn.execute(
+                        "UPDATE papers SET mtime = ?, size = ? WHERE file_name = ?",
+                        (stat.st_mtime, stat.st_size, file_name)
+                    )
+                    seen.add(file_name)
+                    continue
+                try:
+                    with open(file_path, encoding='utf-8') as f:
+                        json_data = json.load(f)
+                    sections = extract_sections(json_data)
+                except Exception as e:
+                    print(f"Error: failed to load '{file_path}': {e}")
+                    continue
+                self.conn.execute("DELETE FROM sections WHERE file_name = ?", (file_name,))
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO papers VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        file_name, stat.st_mtime, stat.st_size, content_hash,
+                        json.dumps(json_data['structure'], ensure_ascii=False),
+                        "\n".join(json_data['data'].values())
+                    )
+                )
+                self.conn.executemany(
+                    "INSERT INTO sections VALUES (?, ?, ?)",
+                    [(file_name, sn, text) for sn, text in sections.items()]
+                )
+                seen.add(file_name)
+                updated_num += 1
+            removed = [(file_name,) for file_name in known if file_name not in seen]
+            self.conn.executemany("DELETE FROM papers WHERE file_name = ?", removed)
+            self.conn.executemany("DELETE FROM sections WHERE file_name = ?", removed)
+            self.conn.commit()
+        if updated_num or removed:
+            print(f"corpus refreshed: {updated_num} papers updated, {len(removed)} removed.")
+        return updated_num
+
+    def query(self, sql, parameters=()):
+        with self.lock:
+            return self.conn.execute(sql, parameters).fetchall()
+
+    def file_names(self):
+        return [row[0] for row in self.query("SELECT file_name FROM papers ORDER BY file_name")]
+
+    def content_hash(self, file_name):
+        rows = self.query("SELECT hash FROM papers WHERE file_name = ?", (file_name,))
+        return rows[0][0] if rows else None
+
+    def hashes(self):
+        return dict(self.query("SELECT file_name, hash FROM papers ORDER BY file_name"))
+
+    def structure(self, file_name):
+        rows = self.query("SELECT structure FROM papers WHERE file_name = ?", (file_name,))
+        return json.loads(rows[0][0]) if rows else None
+
+    def text(self, file_name):
+        rows = self.query("SELECT text FROM papers WHERE file_name = ?", (file_name,))
+        return rows[0][0] if rows else None
+
+    def sections(self, file_name):
+        return dict(self.query("SELECT section, text FROM sections WHERE file_name = ?", (file_name,)))
+
+    def close(self):
+        self.conn.close()
+
+
+def compile_corpus(json_dir, db_path=None, shard=None):
+    corpus = Corpus(json_dir, db_path, shard)
+    corpus.refresh()
+    return corpus
@@ -0,0 +1,180 @@
+import re
+import random
+import hashlib
+from collections import defaultdict
+from knowledge_store import normalize_name
+
+mersenne_prime = (1 << 61) - 1
+
+def hash_shingle(shingle):
+    return int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'little')
+
+# parentheticals that mark a name as the paper's own instead of abbreviating it
+generic_parentheticals = {"ours", "our", "our method", "our model", "proposed", "this work", "this paper", "new", "baseline"}
+
+def is_acronym(short, long_name):
+    # "vit" / "vision transformer": the letters of short appear in order in
+    # long_name, starting with its first letter and taking the initials of at
+    # least two of its words
+    short = re.sub(r'[^\w]+', '', short)
+    text = " ".join(re.findall(r'\w+', long_name))
+    if len(short) < 2 or not text or short[0] != text[0]:
+        return False
+    position, initials = 1, 1
+    for char in short[1:]:
+        # a letter is taken as the initial of a later word where there is one
+        word_start = text.find(" " + char, position - 1)
+        position = word_start + 1 if word_start != -1 else text.find(char, position)
+        if position == -1:
+            return False
+        initials += word_start != -1
+        position += 1
+    return initials >= min(2, len(text.split()))
+
+def name_aliases(name):
+    # the normalized name plus, for names like "Vision Transformer (ViT)", the
+    # name without the parenthetical; returns the aliases and the acronym, the
+    # parenthetical if it abbreviates the outer name, else None
+    norm_name = normalize_name(name)
+    aliases = {norm_name}
+    acronym = None
+    match = re.fullmatch(r'(.+?)\s*\((.+)\)', norm_name)
+    if match:
+        outer, inner = match.group(1).strip(), match.group(2).strip()
+        aliases.add(outer)
+        if inner not in generic_parentheticals and is_acronym(inner, outer):
+            acronym = inner
+    return {alias for alias in aliases if len(alias) > 1 and not alias.isdigit()}, acronym
+
+def entity_shingles(entity, use_description=True):
+    name = re.sub(r'[^\w]+', ' ', normalize_name(entity.get("name", ""))).strip()
+    padded_name = f" {name} "
+    shingles = {f"n:{padded_name[i:i + 3]}" for i in range(max(len(padded_name) - 2, 1))}
+    if use_description:
+        for description in entity.get("description", []):
+            shingles.update(f"d:{word}" for word in re.findall(r'\w+', str(description).casefold()) if len(word) > 2)
+    return shingles
+
+
+class MinHasher:
+    def __init__(self, num_perm=32, seed=1):
+        rng = random.Random(seed)
+        self.permutations = [
+            (rng.randrange(1, mersenne_prime), rng.randrange(0, mersenne_prime))
+            for _ in range(num_perm)
+        ]
+
+    def signature(self, shingles):
+        hashes = [hash_shingle(shingle) for shingle in shingles] or [0]
+        return tuple(
+            min((a * h + b) % mersenne_prime for h in hashes)
+            for a, b in self.permutations
+        )
+
+
+def choose_bands(num_perm, threshold):
+    # band count whose LSH threshold (1/bands)^(1/rows) is closest to threshold
+    best = None
+    for bands in range(1, num_perm + 1):
+        if num_perm % bands != 0:
+            continue
+        rows = num_perm // bands
+        distance = abs((1 / bands) ** (1 / rows) - threshold)
+        if best is None or distance < best[0]:
+            best = (distance, bands, rows)
+    return best[1], best[2]
+
+
+class UnionFind:
+    def __init__(self, size):
+        self.parent = list(range(size))
+
+    def find(self, x):
+        while self.parent[x] != x:
+            self.parent[x] = self.parent[self.parent[x]]
+            x = self.parent[x]
+        return x
+
+    def union(self, x, y):
+        root_x, root_y = self.find(x), self.find(y)
+        if root_x != root_y:
+            self.parent[max(root_x, root_y)] = min(root_x, root_y)
+
+
+def cluster_entities(entities, threshold=0.8, num_perm=32, use_description=True, max_bucket_size=200):
+    # candidate pairs come from shared name aliases and from MinHash LSH buckets,
+    # LSH candidates are only merged if their estimated Jaccard similarity reaches threshold;
+    # an acronym ("ViT") joins its expansion only if no other expansion shares it,
+    # "Reinforcement Learning (RL)" and "Representation Learning (RL)" are left to LSH
+    union_find = UnionFind(len(entities))
+
+    alias_owner = {}
+    acronym_expansions = defaultdict(dict)
+    for idx, entity in enumerate(entities):
+        aliases, acronym = name_aliases(entity.get("name", ""))
+        for alias in aliases:
+            if alias in alias_owner:
+                union_find.union(alias_owner[alias], idx)
+            else:
+                alias_owner[alias] = idx
+        if acronym is not None:
+            acronym_expansions[acronym].setdefault(min(aliases, key=len), idx)
+    for acronym, expansions in acronym_expansions.items():
+        if acronym in alias_owner and len(expansions) == 1:
+            union_find.union(alias_owner[acronym], next(iter(expansions.values())))
+
+    min_hasher = MinHasher(num_perm)
+    signatures = [min_hasher.signature(entity_shingles(entity, use_description)) for entity in entities]
+    bands, rows = choose_bands(num_perm, threshold)
+    for band in range(bands):
+        buckets = defaultdict(list)
+        for idx, signature in enumerate(signatures):
+            buckets[signature[band * rows:(band + 1) * rows]].append(idx)
+        for members in buckets.values():
+            if len(members) < 2:
+                continue
+            if len(members) > max_bucket_size:
+                # a degenerate bucket (e.g. empty descriptions), comparing it pairwise would be quadratic
+                continue
+            for i, x in enumerate(members):
+                for y in members[i + 1:]:
+                    if union_find.find(x) == union_find.find(y):
+                        continue
+                    similarity = sum(a == b for a, b in zip(signatures[x], signatures[y])) / num_perm
+                    if similarity >= threshold:
+                        union_find.union(x, y)
+
+    clusters = defaultdict(list)
+    for idx in range(len(entities)):
+        clusters[union_find.find(idx)].append(idx)
+    return list(clusters.values())
+
+
+def merge_cluster(entities, attribute_names):
+    # the entity with the most attribute values gives the merged name,
+    # ties go to the name with less stray punctuation and then the longer one
+    canonical = max(entities, key=lambda entity: (
+        sum(len(entity.get(attribute_name, [])) for attribute_name in attribute_names),
+        -len(re.findall(r'[^\w\s()]', entity["name"])),
+        len(entity["name"])
+    ))
+    merged = {"name": canonical["name"]}
+    for attribute_name in attribute_names:
+        values = []
+        seen = set()
+        for entity in entities:
+            for value in entity.get(attribute_name, []):
+                value_key = repr(value)
+                if value_key not in seen:
+                    seen.add(value_key)
+                    values.append(value)
+        merged[attribute_name] = values
+    return merged
+
+
+def dedup_entities(entities, attribute_names, threshold=0.8, num_perm=32, use_description=True):
+    entities = [entity for entity in entities if isinstance(entity, dict) and entity.get("name")]
+    clusters = cluster_entities(entities, threshold, num_perm, use_description)
+    merged_entities = [merge_cluster([entities[idx] for idx in cluster], attribute_names) for cluster in clusters]
+    print(f"dedup: {len(entities)} entities consolidated into {len(merged_entities)}.")
+    return merged_entities
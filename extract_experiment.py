@@ -2,84 +2,47 @@ import os
 import re
 import json
 import argparse
+import asyncio
+from itertools import chain
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from util import client, extract_from_code_block, extract_json_from_str
+from util import client, async_client, extract_from_code_block, extract_json_from_str, pack_by_token_budget, repair_json, parse_or_invalidate, add_llm_arguments, apply_llm_arguments
+from journal import Journal
+from corpus import compile_corpus
+from sharding import parse_shard, shard_path, existing_shard_paths
 
 os.makedirs("./extract_infomation", exist_ok=True)
 
+experiment_journal_path = "./extract_infomation/experiment_journal.jsonl"
+experiment_path = "./extract_infomation/experiment.json"
+
 
 extract_experiment_prompt = '''Please read the input text and follow these instructions:
 1. Extract the experiment types (e.g., ablation studies, hyperparameter tuning, etc.), baselines, benchmarks, and metrics from the input text.
 2. The output should be presented within a code block in the following format: "json\n<output>", where "<output>" is the placeholder for the output.
 '''
-    
-def concatenate_values(structure):
-    result = []
-    if isinstance(structure, str):
-        result.append(structure)
-    if isinstance(structure, list):
-        if len(structure) != 0:
-            for v in structure:
-                result.append(concatenate_values(v))
-    if isinstance(structure, dict):
-        if len(structure.values()) != 0:
-            for v in structure.values():
-                result.append(concatenate_values(v))
-    result = [item for item in result if item is not None]
-    return "\n".join(result)
-    
-def read_structure_data(json_path):
-    section_name_list = [
-        "title",
-        "abstract",
-        "introduction",
-        "related work",
-        "experiment",
-        "conclusion",
-        "limitation",
-        "reference",
-        "appendix",
-        "checklist",
-        "image",
-        "table",
-    ]
-    with open(json_path, encoding='utf-8') as f:
-        json_data = json.load(f)
-    new_json_data = dict()
-    for key in json_data['structure'].keys():
-        for sn in section_name_list:
-            if sn in key.lower():
-                new_json_data[sn] = concatenate_values(json_data['structure'][key])
-    empty_key_list = []
-    for key in new_json_data.keys():
-        value_idx_list = new_json_data[key].split("\n")
-        value_list = []
-        for idx in value_idx_list:
-            if idx != "":
-                value_list.append(json_data['data'][idx])
-        new_json_data[key] = "\n".join(value_list)
-        if new_json_data[key] == "":
-            empty_key_list.append(key)
-    for key in empty_key_list:
-        new_json_data.pop(key)
-    if "related work" in new_json_data.keys():
-        new_json_data['related_work'] = new_json_data['related work']
-        new_json_data.pop("related work")
-    return new_json_data
 
+batched_extract_experiment_prompt = '''Please read every input text in the input json, and follow these instructions for each text separately:
+1. Extract the experiment types (e.g., ablation studies, hyperparameter tuning, etc.), baselines, benchmarks, and metrics from the text.
+2. Answer with a json array holding one object per input text, with the key of the text under "key" and the extracted lists under "experiment_types", "baselines", "benchmarks" and "metrics".
+3. The output should be presented within a code block in the following format: "```json\n<output>```", where "<output>" is the placeholder for the output.
+4. An example is as follows:
 
-def extract_experiment_info(input_text):
-    global extract_experiment_prompt, client
-    completion = client.chat.completions.create(
-        model="qwen-plus",
-        messages=[
-            {'role': 'system', 'content': extract_experiment_prompt},
-            {'role': 'user', 'content': f'input text\n{input_text}'}
-        ],
-        stream=False,
-        temperature=0.01
-    )
-    result = completion.choices[0].message.content
+```json
+[
+    {"key": "1", "experiment_types": ["ablation study"], "baselines": ["ResNet-50"], "benchmarks": ["ImageNet"], "metrics": ["top-1 accuracy"]},
+    {"key": "2", "experiment_types": ["hyperparameter tuning"], "baselines": ["BERT-base"], "benchmarks": ["GLUE"], "metrics": ["F1"]}
+]
+```
+'''
+
+def build_experiment_messages(input_text):
+    global extract_experiment_prompt
+    return [
+        {'role': 'system', 'content': extract_experiment_prompt},
+        {'role': 'user', 'content': f'input text\n{input_text}'}
+    ]
+
+def parse_experiment_result(result):
     result_str_list = extract_from_code_block(result)
     if len(result_str_list) > 0:
         result_str = result_str_list[0]
@@ -87,6 +50,76 @@ def extract_experiment_info(input_text):
         return result_json
     return {}
 
+def build_batched_experiment_messages(text_dict):
+    global batched_extract_experiment_prompt
+    return [
+        {'role': 'system', 'content': batched_extract_experiment_prompt},
+        {'role': 'user', 'content': f'```json\n{json.dumps(text_dict, ensure_ascii=False)}```'}
+    ]
+
+def parse_batched_experiment_result(result, key_list):
+    # raises if the answer does not hold an object for every key
+    result_str_list = extract_from_code_block(result)
+    result_json = repair_json(result_str_list[0])
+    if isinstance(result_json, dict):
+        result_json = [dict(value, key=key) for key, value in result_json.items()]
+    experiments = {}
+    for experiment in result_json:
+        experiment = dict(experiment)
+        experiments[str(experiment.pop("key"))] = experiment
+    return [experiments[key] for key in key_list]
+
+def extract_experiment_info(input_text):
+    global client
+    request = dict(model="qwen-plus", messages=build_experiment_messages(input_text), temperature=0.01)
+    completion = client.chat.completions.create(**request, stream=False, code_blocks=1)
+    result = completion.choices[0].message.content
+    return parse_or_invalidate(client.chat.completions, request, result, parse_experiment_result, bool)
+
+async def async_extract_experiment_info(input_text):
+    global async_client
+    request = dict(model="qwen-plus", messages=build_experiment_messages(input_text), temperature=0.01)
+    completion = await async_client.chat.completions.create(**request, stream=False, code_blocks=1)
+    result = completion.choices[0].message.content
+    # parsing may fall back to the blocking LLM json repair, keep it off the event loop
+    return await asyncio.to_thread(parse_or_invalidate, async_client.chat.completions, request, result, parse_experiment_result, bool)
+
+def extract_experiment_info_batched(text_list):
+    # one request for several experiment sections; a batch whose answer
+    # cannot be split back out is split in halves and retried
+    global client
+    if len(text_list) == 1:
+        return [extract_experiment_info(text_list[0])]
+    key_list = [str(i + 1) for i in range(len(text_list))]
+    request = dict(model="qwen-plus", messages=build_batched_experiment_messages(dict(zip(key_list, text_list))), temperature=0.01)
+    try:
+        completion = client.chat.completions.create(**request, stream=False, code_blocks=1)
+        result = completion.choices[0].message.content
+        return parse_or_invalidate(client.chat.completions, request, result, lambda result: parse_batched_experiment_result(result, key_list), all)
+    except Exception as e:
+        print(f"batched request of {len(text_list)} experiment sections failed, splitting it: {e}")
+        half = len(text_list) // 2
+        return extract_experiment_info_batched(text_list[:half]) + extract_experiment_info_batched(text_list[half:])
+
+async def async_extract_experiment_info_batched(text_list):
+    global async_client
+    if len(text_list) == 1:
+        return [await async_extract_experiment_info(text_list[0])]
+    key_list = [str(i + 1) for i in range(len(text_list))]
+    request = dict(model="qwen-plus", messages=build_batched_experiment_messages(dict(zip(key_list, text_list))), temperature=0.01)
+    try:
+        completion = await async_client.chat.completions.create(**request, stream=False, code_blocks=1)
+        result = completion.choices[0].message.content
+        return parse_or_invalidate(async_client.chat.completions, request, result, lambda result: parse_batched_experiment_result(result, key_list), all)
+    except Exception as e:
+        print(f"batched request of {len(text_list)} experiment sections failed, splitting it: {e}")
+        half = len(text_list) // 2
+        first, second = await asyncio.gather(
+            async_extract_experiment_info_batched(text_list[:half]),
+            async_extract_experiment_info_batched(text_list[half:])
+        )
+        return first + second
+
 def merge_experiment_info(experiment_list):
     merged_experiment = {
         "experiment_types": set(),
@@ -95,6 +128,9 @@ def merge_experiment_info(experiment_list):
         "metrics": set(),
     }
     for experiment in experiment_list:
+        # journals of earlier runs may hold the None of an unparsed answer
+        if not isinstance(experiment, dict):
+            continue
         for key in merged_experiment.keys():
             if key in experiment:
                 merged_experiment[key].update(experiment[key])
@@ -104,33 +140,123 @@ def merge_experiment_info(experiment_list):
     
     return merged_experiment
 
-def batch_extract_experiment_infomation(json_dir):
+def collect_experiment_data(corpus, journal):
     experiment_data_list = []
-    for file_name in os.listdir(json_dir):
-        file_path = os.path.join(json_dir, file_name)
-        json_data = read_structure_data(file_path)
+    for file_name, content_hash in corpus.hashes().items():
+        if journal.is_done(file_name, content_hash):
+            continue
+        json_data = corpus.sections(file_name)
         if "experiment" in json_data.keys():
-            experiment_data_list.append(json_data['experiment'])
+            experiment_data_list.append((file_name, content_hash, json_data['experiment']))
+    return experiment_data_list
 
-    with ThreadPoolExecutor(max_workers=4) as executor:
-        futures = [executor.submit(extract_experiment_info, input_text) for input_text in experiment_data_list]
-        experiment_results = [future.result() for future in as_completed(futures)]
+def compact_experiment_info():
+    # merges the journaled results into experiment.json, streaming the journal
+    global experiment_journal_path, experiment_path
+    previous_experiment_infomation = []
+    if os.path.exists(experiment_path):
+        with open(experiment_path, encoding='utf-8') as f:
+            previous_experiment_infomation = [json.load(f)]
 
-    merged_experiment = merge_experiment_info(experiment_results)
+    with Journal(experiment_journal_path, resume=True) as journal:
+        merged_experiment = merge_experiment_info(chain(previous_experiment_infomation, journal.iter_results()))
+
+    with open(experiment_path, 'w', encoding='utf-8') as f:
+        json.dump(merged_experiment, f, indent=4)
 
-    if os.path.exists("./extract_infomation/experiment.json"):
-        with open("./extract_infomation/experiment.json", encoding='utf-8') as f:
-            previous_experiment_infomation = json.load(f)
-        merged_experiment = merge_experiment_info([previous_experiment_infomation, merged_experiment])
+def use_shard(shard):
+    # switches the journal and output to the shard-local ones, e.g. experiment.shard-0-of-4.json
+    global experiment_journal_path, experiment_path
+    experiment_journal_path = shard_path(experiment_journal_path, shard)
+    experiment_path = shard_path(experiment_path, shard)
 
-    with open("./extract_infomation/experiment.json", 'w', encoding='utf-8') as f:
+def merge_experiment_shards(shard_count):
+    global experiment_path
+    experiment_list = []
+    for path in existing_shard_paths(experiment_path, shard_count):
+        with open(path, encoding='utf-8') as f:
+            experiment_list.append(json.load(f))
+    merged_experiment = merge_experiment_info(experiment_list)
+    with open(experiment_path, 'w', encoding='utf-8') as f:
         json.dump(merged_experiment, f, indent=4)
+    print(f"merged {len(experiment_list)} shards into {experiment_path}.")
+
+def batch_extract_experiment_infomation(json_dir, resume=False, corpus=None, compact=True, pack_tokens=0):
+    # pack_tokens > 0 batches several experiment sections into one request up to that many input tokens
+    global experiment_journal_path
+    if corpus is None:
+        corpus = compile_corpus(json_dir)
+    with Journal(experiment_journal_path, resume=resume) as journal:
+        experiment_data_list = collect_experiment_data(corpus, journal)
+        batches = pack_by_token_budget(experiment_data_list, pack_tokens, lambda item: item[2])
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = {
+                executor.submit(extract_experiment_info_batched, [item[2] for item in batch]): batch
+                for batch in batches
+            }
+            for future in as_completed(futures):
+                batch = futures[future]
+                try:
+                    results = future.result()
+                except Exception as exc:
+                    # left out of the journal, so a --resume run extracts them again
+                    print(f"extract error for {len(batch)} papers: {exc}")
+                    continue
+                for (file_name, content_hash, _), result in zip(batch, results):
+                    journal.append(file_name, content_hash, result)
+
+    if compact:
+        compact_experiment_info()
+
+async def async_batch_extract_experiment_infomation(json_dir, resume=False, corpus=None, compact=True, pack_tokens=0):
+    global experiment_journal_path
+    if corpus is None:
+        corpus = compile_corpus(json_dir)
+    with Journal(experiment_journal_path, resume=resume) as journal:
+        experiment_data_list = collect_experiment_data(corpus, journal)
+        batches = pack_by_token_budget(experiment_data_list, pack_tokens, lambda item: item[2])
+
+        async def extract_and_journal(batch):
+            try:
+                results = await async_extract_experiment_info_batched([item[2] for item in batch])
+            except Exception as exc:
+                print(f"extract error for {len(batch)} papers: {exc}")
+                return
+            for (file_name, content_hash, _), result in zip(batch, results):
+                journal.append(file_name, content_hash, result)
+
+        await asyncio.gather(*[extract_and_journal(batch) for batch in batches])
+
+    if compact:
+        compact_experiment_info()
 
 def main():
     parser = argparse.ArgumentParser(description="extract experiment information from JSON files in a directory.")
     parser.add_argument("json_dir", type=str, help="Directory containing JSON files")
+    add_llm_arguments(parser)
+    parser.add_argument("--async_mode", action="store_true", help="Use the asyncio client instead of a thread pool")
+    parser.add_argument("--pack_tokens", type=int, default=0, help="Batch several experiment sections into one request up to this many input tokens (0 disables batching)")
+    parser.add_argument("--resume", action="store_true", help="Skip papers already recorded in the journal of a previous run")
+    parser.add_argument("--no_compact", action="store_true", help="Only append results to the journal, do not merge them into experiment.json")
+    parser.add_argument("--compact_only", action="store_true", help="Merge the journal into experiment.json without extracting anything")
+    parser.add_argument("--shard", type=parse_shard, default=None, help="Only process shard i of N (given as i/N) of the papers, with shard-local journal and output")
+    parser.add_argument("--merge_shards", type=int, default=None, help="Merge the outputs of N shards into experiment.json without extracting anything")
     args = parser.parse_args()
 
+    apply_llm_arguments(args)
+
+    if args.merge_shards is not None:
+        merge_experiment_shards(args.merge_shards)
+        return
+
+    if args.shard is not None:
+        use_shard(args.shard)
+
+    if args.compact_only:
+        compact_experiment_info()
+        return
+
     json_dir = args.json_dir
 
     if not os.path.exists(json_dir):
@@ -141,7 +267,11 @@ def main():
         print(f"Error: '{json_dir}' is not a directory.")
         return
 
-    batch_extract_experiment_infomation(json_dir)
+    corpus = compile_corpus(json_dir, shard=args.shard)
+    if args.async_mode:
+        asyncio.run(async_batch_extract_experiment_infomation(json_dir, args.resume, corpus=corpus, compact=not args.no_compact, pack_tokens=args.pack_tokens))
+    else:
+        batch_extract_experiment_infomation(json_dir, args.resume, corpus=corpus, compact=not args.no_compact, pack_tokens=args.pack_tokens)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -2,12 +2,23 @@ import os
 import re
 import json
 import argparse
+import asyncio
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
-from util import client, extract_from_code_block, extract_json_from_str
+from util import client, async_client, extract_from_code_block, extract_json_from_str, parse_or_invalidate, add_llm_arguments, apply_llm_arguments
+from journal import Journal
+from corpus import compile_corpus
+from sharding import parse_shard, shard_path, existing_shard_paths
+from knowledge_store import KnowledgeStore, task_attribute_names, technique_attribute_names
+from entity_dedup import dedup_entities
 
 os.makedirs("./extract_infomation", exist_ok=True)
 
+task_technique_journal_path = "./extract_infomation/task_technique_journal.jsonl"
+task_path = "./extract_infomation/task.json"
+technique_path = "./extract_infomation/technique.json"
+knowledge_store_path = "./extract_infomation/knowledge.sqlite"
+
 extract_task_technique_prompt = '''Please read the input text and follow these instructions:
 1. Extract the task name, description, challenges and latent techniques of solution from the input text into the first code block.
 2. Extract the techique name, description, advantages, disadvantages, targeted tasks and project urls from the input text into the second code block.
@@ -37,73 +48,14 @@ Output examples are as follows:
 '''
 
     
-def concatenate_values(structure):
-    result = []
-    if isinstance(structure, str):
-        result.append(structure)
-    if isinstance(structure, list):
-        if len(structure) != 0:
-            for v in structure:
-                result.append(concatenate_values(v))
-    if isinstance(structure, dict):
-        if len(structure.values()) != 0:
-            for v in structure.values():
-                result.append(concatenate_values(v))
-    result = [item for item in result if item is not None]
-    return "\n".join(result)
-    
-def read_structure_data(json_path):
-    section_name_list = [
-        "title",
-        "abstract",
-        "introduction",
-        "related work",
-        "experiment",
-        "conclusion",
-        "limitation",
-        "reference",
-        "appendix",
-        "checklist",
-        "image",
-        "table",
+def build_task_technique_messages(input_text):
+    global extract_task_technique_prompt
+    return [
+        {'role': 'system', 'content': extract_task_technique_prompt},
+        {'role': 'user', 'content': f'input text\n{input_text}'}
     ]
-    with open(json_path, encoding='utf-8') as f:
-        json_data = json.load(f)
-    new_json_data = dict()
-    for key in json_data['structure'].keys():
-        for sn in section_name_list:
-            if sn in key.lower():
-                new_json_data[sn] = concatenate_values(json_data['structure'][key])
-    empty_key_list = []
-    for key in new_json_data.keys():
-        value_idx_list = new_json_data[key].split("\n")
-        value_list = []
-        for idx in value_idx_list:
-            if idx != "":
-                value_list.append(json_data['data'][idx])
-        new_json_data[key] = "\n".join(value_list)
-        if new_json_data[key] == "":
-            empty_key_list.append(key)
-    for key in empty_key_list:
-        new_json_data.pop(key)
-    if "related work" in new_json_data.keys():
-        new_json_data['related_work'] = new_json_data['related work']
-        new_json_data.pop("related work")
-    return new_json_data
-
 
-def extract_task_technique(input_text):
-    global extract_task_technique_prompt, client
-    completion = client.chat.completions.create(
-        model="qwen-plus",
-        messages=[
-            {'role': 'system', 'content': extract_task_technique_prompt},
-            {'role': 'user', 'content': f'input text\n{input_text}'}
-        ],
-        stream=False,
-        temperature=0.01
-    )
-    result = completion.choices[0].message.content
+def parse_task_technique_result(result):
     result_json_list = extract_from_code_block(result)
     if len(result_json_list) > 0:
         task_json_str = result_json_list[0]
@@ -114,6 +66,20 @@ def extract_task_technique(input_text):
         return task_json, technique_json
     return {}, {}
 
+def extract_task_technique(input_text):
+    global client
+    request = dict(model="qwen-plus", messages=build_task_technique_messages(input_text), temperature=0.01)
+    completion = client.chat.completions.create(**request, stream=False, code_blocks=2)
+    result = completion.choices[0].message.content
+    return parse_or_invalidate(client.chat.completions, request, result, parse_task_technique_result, all)
+
+async def async_extract_task_technique(input_text):
+    global async_client
+    request = dict(model="qwen-plus", messages=build_task_technique_messages(input_text), temperature=0.01)
+    completion = await async_client.chat.completions.create(**request, stream=False, code_blocks=2)
+    result = completion.choices[0].message.content
+    return await asyncio.to_thread(parse_or_invalidate, async_client.chat.completions, request, result, parse_task_technique_result, all)
+
 def merge_task_info(task_list):
     merged_tasks = {}
 
@@ -154,54 +120,168 @@ def merge_technique_info(technique_list):
 
     return list(merged_techniques.values())
 
-def batch_extract_task_technique_infomation(json_dir):
+def collect_task_technique_data(corpus, journal):
     task_technique_list = []
-    for file_name in os.listdir(json_dir):
-        file_path = os.path.join(json_dir, file_name)
-        json_data = read_structure_data(file_path)
+    for file_name, content_hash in corpus.hashes().items():
+        if journal.is_done(file_name, content_hash):
+            continue
+        json_data = corpus.sections(file_name)
         task_technique_text = ""
         sn_list = "abstract introduction conclusion limitation".split(" ")
         for sn in sn_list:
             if sn in json_data.keys():
                 task_technique_text += json_data[sn] + "\n"
         task_technique_text = task_technique_text.strip("\n")
-        task_technique_list.append(task_technique_text)
-
-    task_results = []
-    technique_results =[]
-    with ThreadPoolExecutor(max_workers=4) as executor:
-        futures = [executor.submit(extract_task_technique, input_text) for input_text in task_technique_list]
-        for future in tqdm(as_completed(futures), total=len(futures), desc="Processing"):
-            task, technique = future.result()
-            task_results.append(task)
-            technique_results.append(technique)
-
-    merged_task = merge_task_info(task_results)
-    merged_technique = merge_technique_info(technique_results)
-
-    if os.path.exists("./extract_infomation/task.json"):
-        with open("./extract_infomation/task.json", encoding='utf-8') as f:
-            previous_task_infomation = json.load(f)
-            merged_task.extend(previous_task_infomation)
-            merged_task = merge_task_info(merged_task)
-
-    with open("./extract_infomation/task.json", 'w', encoding='utf-8') as f:
+        task_technique_list.append((file_name, content_hash, task_technique_text))
+    return task_technique_list
+
+def load_previous_infomation(path):
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    return []
+
+def compact_task_technique_info(dedup_threshold=None):
+    # upserts the journal entries not yet in the knowledge store and exports
+    # task.json and technique.json from it, consolidating near-duplicate
+    # names when dedup_threshold is given
+    global task_technique_journal_path, task_path, technique_path, knowledge_store_path
+    store = KnowledgeStore(knowledge_store_path)
+    if store.entity_num("task") == 0 and store.entity_num("technique") == 0:
+        # first use of the store, seed it with the outputs of earlier runs
+        for task in load_previous_infomation(task_path):
+            store.upsert("task", task, task_attribute_names)
+        for technique in load_previous_infomation(technique_path):
+            store.upsert("technique", technique, technique_attribute_names)
+
+    ingested_num = 0
+    with Journal(task_technique_journal_path, resume=True) as journal:
+        for entry in journal.iter_entries():
+            if store.is_ingested("task_technique", entry['key'], entry['hash']):
+                continue
+            task, technique = entry['result']
+            store.upsert("task", task, task_attribute_names)
+            store.upsert("technique", technique, technique_attribute_names)
+            store.mark_ingested("task_technique", entry['key'], entry['hash'])
+            ingested_num += 1
+    store.commit()
+    print(f"knowledge store: {ingested_num} new papers merged.")
+
+    merged_task = store.export("task", task_attribute_names)
+    merged_technique = store.export("technique", technique_attribute_names)
+    store.close()
+    if dedup_threshold is not None:
+        merged_task = dedup_entities(merged_task, task_attribute_names, dedup_threshold)
+        merged_technique = dedup_entities(merged_technique, technique_attribute_names, dedup_threshold)
+
+    with open(task_path, 'w', encoding='utf-8') as f:
         json.dump(merged_task, f, indent=4)
 
-    if os.path.exists("./extract_infomation/technique.json"):
-        with open("./extract_infomation/technique.json", encoding='utf-8') as f:
-            previous_technique_infomation = json.load(f)
-            merged_technique.extend(previous_technique_infomation)
-            merged_technique = merge_technique_info(merged_technique)
+    with open(technique_path, 'w', encoding='utf-8') as f:
+        json.dump(merged_technique, f, indent=4)
+
+def use_shard(shard):
+    # switches the journal, knowledge store and outputs to the shard-local ones, e.g. task.shard-0-of-4.json
+    global task_technique_journal_path, task_path, technique_path, knowledge_store_path
+    task_technique_journal_path = shard_path(task_technique_journal_path, shard)
+    task_path = shard_path(task_path, shard)
+    technique_path = shard_path(technique_path, shard)
+    knowledge_store_path = shard_path(knowledge_store_path, shard)
 
-    with open("./extract_infomation/technique.json", 'w', encoding='utf-8') as f:
+def merge_task_technique_shards(shard_count, dedup_threshold=None):
+    global task_path, technique_path
+    task_list = []
+    for path in existing_shard_paths(task_path, shard_count):
+        task_list.extend(load_previous_infomation(path))
+    technique_list = []
+    for path in existing_shard_paths(technique_path, shard_count):
+        technique_list.extend(load_previous_infomation(path))
+    merged_task = merge_task_info(task_list)
+    merged_technique = merge_technique_info(technique_list)
+    if dedup_threshold is not None:
+        merged_task = dedup_entities(merged_task, task_attribute_names, dedup_threshold)
+        merged_technique = dedup_entities(merged_technique, technique_attribute_names, dedup_threshold)
+
+    with open(task_path, 'w', encoding='utf-8') as f:
+        json.dump(merged_task, f, indent=4)
+
+    with open(technique_path, 'w', encoding='utf-8') as f:
         json.dump(merged_technique, f, indent=4)
+    print(f"merged shards into {len(merged_task)} tasks and {len(merged_technique)} techniques.")
+
+def batch_extract_task_technique_infomation(json_dir, resume=False, corpus=None, compact=True, dedup_threshold=None):
+    global task_technique_journal_path
+    if corpus is None:
+        corpus = compile_corpus(json_dir)
+    with Journal(task_technique_journal_path, resume=resume) as journal:
+        task_technique_list = collect_task_technique_data(corpus, journal)
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = {
+                executor.submit(extract_task_technique, input_text): (file_name, content_hash)
+                for file_name, content_hash, input_text in task_technique_list
+            }
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Processing"):
+                file_name, content_hash = futures[future]
+                try:
+                    task, technique = future.result()
+                except Exception as exc:
+                    # left out of the journal, so a --resume run extracts it again
+                    print(f"extract error for {file_name}: {exc}")
+                    continue
+                journal.append(file_name, content_hash, [task, technique])
+
+    if compact:
+        compact_task_technique_info(dedup_threshold)
+
+async def async_batch_extract_task_technique_infomation(json_dir, resume=False, corpus=None, compact=True, dedup_threshold=None):
+    global task_technique_journal_path
+    if corpus is None:
+        corpus = compile_corpus(json_dir)
+    with Journal(task_technique_journal_path, resume=resume) as journal:
+        task_technique_list = collect_task_technique_data(corpus, journal)
+
+        async def extract_and_journal(file_name, content_hash, input_text):
+            try:
+                task, technique = await async_extract_task_technique(input_text)
+            except Exception as exc:
+                print(f"extract error for {file_name}: {exc}")
+                return
+            journal.append(file_name, content_hash, [task, technique])
+
+        coroutines = [extract_and_journal(*item) for item in task_technique_list]
+        for coroutine in tqdm(asyncio.as_completed(coroutines), total=len(coroutines), desc="Processing"):
+            await coroutine
+
+    if compact:
+        compact_task_technique_info(dedup_threshold)
 
 def main():
     parser = argparse.ArgumentParser(description="extract task and technique information from JSON files in a directory.")
     parser.add_argument("json_dir", type=str, help="Directory containing JSON files")
+    add_llm_arguments(parser)
+    parser.add_argument("--async_mode", action="store_true", help="Use the asyncio client instead of a thread pool")
+    parser.add_argument("--resume", action="store_true", help="Skip papers already recorded in the journal of a previous run")
+    parser.add_argument("--no_compact", action="store_true", help="Only append results to the journal, do not merge them into task.json and technique.json")
+    parser.add_argument("--compact_only", action="store_true", help="Merge the journal into task.json and technique.json without extracting anything")
+    parser.add_argument("--shard", type=parse_shard, default=None, help="Only process shard i of N (given as i/N) of the papers, with shard-local journal, store and outputs")
+    parser.add_argument("--merge_shards", type=int, default=None, help="Merge the outputs of N shards into task.json and technique.json without extracting anything")
+    parser.add_argument("--dedup_threshold", type=float, default=None, help="Consolidate near-duplicate tasks and techniques whose MinHash similarity reaches this threshold (e.g. 0.8)")
     args = parser.parse_args()
 
+    apply_llm_arguments(args)
+
+    if args.merge_shards is not None:
+        merge_task_technique_shards(args.merge_shards, args.dedup_threshold)
+        return
+
+    if args.shard is not None:
+        use_shard(args.shard)
+
+    if args.compact_only:
+        compact_task_technique_info(args.dedup_threshold)
+        return
+
     json_dir = args.json_dir
 
     if not os.path.exists(json_dir):
@@ -212,7 +292,11 @@ def main():
         print(f"Error: '{json_dir}' is not a directory.")
         return
 
-    batch_extract_task_technique_infomation(json_dir)
+    corpus = compile_corpus(json_dir, shard=args.shard)
+    if args.async_mode:
+        asyncio.run(async_batch_extract_task_technique_infomation(json_dir, args.resume, corpus=corpus, compact=not args.no_compact, dedup_threshold=args.dedup_threshold))
+    else:
+        batch_extract_task_technique_infomation(json_dir, args.resume, corpus=corpus, compact=not args.no_compact, dedup_threshold=args.dedup_threshold)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,80 @@
+import time
+import threading
+
+
+class TokenBucket:
+    # refills at rate_per_minute, holding at most burst_seconds worth; take()
+    # may drive the level negative, the debt is the wait of the caller, so
+    # concurrent callers are queued behind each other instead of all waking at once
+    def __init__(self, rate_per_minute, burst_seconds=10):
+        self.rate = rate_per_minute / 60
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, amount, now):
+        # returns the seconds until amount is covered
+        self.refill(now)
+        self.level -= amount
+        return max(0.0, -self.level / self.rate)
+
+    def give_back(self, amount, now):
+        self.refill(now)
+        self.level = min(self.capacity, self.level + amount)
+
+    def wait_time(self, now):
+        self.refill(now)
+        return max(0.0, -self.level / self.rate)
+
+
+class RateGovernor:
+    # per-endpoint pacing: rpm/tpm from the endpoint's config entry (either may
+    # be None), tokens are reserved from an estimate of the prompt and settled
+    # with the usage of the response, and a 429 pauses the endpoint for its
+    # Retry-After; reserve() only computes the wait, so the sync and the async
+    # wrappers sleep in their own way
+    def __init__(self, rpm=None, tpm=None):
+        self.lock = threading.Lock()
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.paused_until = 0.0
+
+    def reserve(self, estimated_tokens):
+        now = time.monotonic()
+        with self.lock:
+            wait = max(0.0, self.paused_until - now)
+            if self.requests is not None:
+                wait = max(wait, self.requests.take(1, now))
+            if self.tokens is not None:
+                wait = max(wait, self.tokens.take(estimated_tokens, now))
+        return wait
+
+    def settle(self, estimated_tokens, used_tokens):
+        # used_tokens is None for an answer without usage, e.g. an aborted stream
+        if self.tokens is None or used_tokens is None:
+            return
+        now = time.monotonic()
+        with self.lock:
+            if used_tokens > estimated_tokens:
+                self.tokens.take(used_tokens - estimated_tokens, now)
+            else:
+                self.tokens.give_back(estimated_tokens - used_tokens, now)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def pending_wait(self):
+        # how long a request reserved now would wait, used to route around a throttled endpoint
+        now = time.monotonic()
+        with self.lock:
+            wait = max(0.0, self.paused_until - now)
+            if self.requests is not None:
+                wait = max(wait, self.requests.wait_time(now))
+            if self.tokens is not None:
+                wait = max(wait, self.tokens.wait_time(now))
+        return wait
@@ -0,0 +1,127 @@
+import os
+import re
+import json
+from collections import defaultdict
+
+# the top-level nodes of reshape_prompt in structures_check.py, the prompt's
+# "Checlist" is spelled out so that corpus.extract_sections recognizes it
+top_level_node_list = [
+    "Title", "Abstract", "Introduction", "Related Work", "Method", "Experiments",
+    "Conclusion", "Limitations", "References", "Appendix", "Checklist", "Image", "Table"
+]
+
+heading_patterns = [
+    (re.compile(r'title'), "Title"),
+    (re.compile(r'abstract'), "Abstract"),
+    (re.compile(r'introduction'), "Introduction"),
+    (re.compile(r'(related works?|prior works?|previous works?|literature review)'), "Related Work"),
+    (re.compile(r'(methods?|methodology|approach|our approach|proposed method|proposed approach)'), "Method"),
+    (re.compile(r'(experiments?|experimental (results|setup|evaluation)|evaluation|results)'), "Experiments"),
+    (re.compile(r'(conclusions?|concluding remarks)( and (future work|outlook|discussion))?'), "Conclusion"),
+    (re.compile(r'limitations?( and .+)?'), "Limitations"),
+    (re.compile(r'(references?|bibliography)'), "References"),
+    (re.compile(r'(appendix|appendices|supplementary( material)?)\b.*'), "Appendix"),
+    (re.compile(r'(neurips |paper )?checklist'), "Checklist"),
+    (re.compile(r'(figure|fig)\s*\d+.*'), "Image"),
+    (re.compile(r'table\s*\d+.*'), "Table"),
+]
+
+def heading_key(heading):
+    # "5. Experiments" / "V EXPERIMENTS" / "A) Experiments:" -> "experiments"
+    heading = " ".join(str(heading).split())
+    heading = re.sub(r'^(?:[IVXL]+|\d+(?:\.\d+)*|[A-Z])[.):]?\s+', '', heading)
+    return heading.casefold().strip(" .:;")
+
+def names_node(heading, node):
+    key = heading_key(heading)
+    return any(pattern.fullmatch(key) for pattern, pattern_node in heading_patterns if pattern_node == node)
+
+def structure_leaves(node):
+    if isinstance(node, dict):
+        return [leaf for value in node.values() for leaf in structure_leaves(value)]
+    if isinstance(node, list):
+        return [leaf for item in node for leaf in structure_leaves(item)]
+    return [node]
+
+
+class HeadingNormalizer:
+    # maps top-level headings to the top-level nodes of the structure review:
+    # first through heading_patterns, then through a table learned from the
+    # reviews accepted by rewrite, where a heading needs min_votes agreeing
+    # reviews, so a single bad answer does not decide it; a structure is
+    # normalized locally only when every one of its top-level headings is mapped
+    def __init__(self, table_path="./structures/heading_table.json", min_votes=2, min_share=0.8):
+        self.table_path = table_path
+        self.min_votes = min_votes
+        self.min_share = min_share
+        self.votes = defaultdict(dict)
+        if os.path.exists(table_path):
+            with open(table_path, encoding='utf-8') as f:
+                for key, node_votes in json.load(f).items():
+                    self.votes[key] = dict(node_votes)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.table_path) or ".", exist_ok=True)
+        with open(self.table_path + ".tmp", 'w', encoding='utf-8') as f:
+            json.dump(self.votes, f, indent=4, ensure_ascii=False, sort_keys=True)
+        os.replace(self.table_path + ".tmp", self.table_path)
+
+    def lookup(self, heading):
+        key = heading_key(heading)
+        for pattern, node in heading_patterns:
+            if pattern.fullmatch(key):
+                return node
+        node_votes = self.votes.get(key)
+        if node_votes:
+            node, count = max(node_votes.items(), key=lambda x: x[1])
+            if count >= self.min_votes and count >= self.min_share * sum(node_votes.values()):
+                return node
+        return None
+
+    def normalize(self, structure):
+        # returns the normalized structure, or None if a heading is not mapped;
+        # a heading naming its node ("5. Experiments") is renamed to it, any
+        # other heading ("3 Our Model" -> Method) becomes a sub-node, as do
+        # several headings mapped to the same node
+        if not isinstance(structure, dict) or not structure:
+            return None
+        grouped = defaultdict(list)
+        for heading, value in structure.items():
+            node = self.lookup(heading)
+            if node is None:
+                return None
+            grouped[node].append((heading, value))
+        normalized = {}
+        for node, entries in grouped.items():
+            heading, value = entries[0]
+            if len(entries) == 1 and names_node(heading, node):
+                normalized[node] = value
+            else:
+                normalized[node] = {heading: value for heading, value in entries}
+        return normalized
+
+    def learn(self, structure, reviewed_structure):
+        # a top-level heading whose leaves all ended up under one top-level
+        # node of the reviewed structure votes for that node
+        if not isinstance(structure, dict) or not isinstance(reviewed_structure, dict):
+            return
+        leaf_nodes = {}
+        for node, value in reviewed_structure.items():
+            if node in top_level_node_list:
+                for leaf in structure_leaves(value):
+                    if isinstance(leaf, str):
+                        leaf_nodes[leaf] = node
+        for heading, value in structure.items():
+            nodes = {leaf_nodes.get(leaf) for leaf in structure_leaves(value)}
+            if len(nodes) == 1 and None not in nodes:
+                node = nodes.pop()
+                node_votes = self.votes[heading_key(heading)]
+                node_votes[node] = node_votes.get(node, 0) + 1
+
+    def merge(self, other):
+        # every shard's table starts from the merged one, so taking the larger
+        # count per heading and node never counts a vote twice
+        for key, node_votes in other.votes.items():
+            merged_votes = self.votes[key]
+            for node, count in node_votes.items():
+                merged_votes[node] = max(merged_votes.get(node, 0), count)
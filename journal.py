@@ -0,0 +1,85 @@
+import os
+import json
+import hashlib
+import threading
+
+
+def file_hash(file_path):
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class Journal:
+    # append-only JSONL log of per-item results, one compact line per finished item:
+    # {"key": <file name>, "hash": <content hash>, "result": <stage output>}
+    # with resume=True the existing entries are kept and items whose key and
+    # hash are already journaled can be skipped, otherwise the journal is reset.
+    # Only key -> (hash, line number) is kept in memory, results are streamed
+    # back from the file, the latest line winning when a key was journaled twice.
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.line_num = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        if resume and os.path.exists(path):
+            self.load()
+        self.f = open(path, 'a' if resume else 'w', encoding='utf-8')
+        if resume and self.f.tell() > 0:
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    # terminate a line cut short by a crash so the next entry starts on its own line
+                    self.f.write("\n")
+
+    def load(self):
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                self.line_num += 1
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # a line cut short by a crash, the item is simply redone
+                    continue
+                self.entries[entry['key']] = (entry['hash'], self.line_num)
+
+    def is_done(self, key, content_hash):
+        entry = self.entries.get(key)
+        return entry is not None and entry[0] == content_hash
+
+    def append(self, key, content_hash, result):
+        entry = {"key": key, "hash": content_hash, "result": result}
+        line = json.dumps(entry, ensure_ascii=False)
+        with self.lock:
+            self.f.write(line + "\n")
+            self.f.flush()
+            self.line_num += 1
+            self.entries[key] = (content_hash, self.line_num)
+
+    def iter_entries(self):
+        with self.lock:
+            self.f.flush()
+            latest_line = {line_num for _, line_num in self.entries.values()}
+        with open(self.path, encoding='utf-8') as f:
+            for line_num, line in enumerate(f, start=1):
+                if line_num in latest_line:
+                    yield json.loads(line)
+
+    def iter_results(self):
+        for entry in self.iter_entries():
+            yield entry['result']
+
+    def results(self):
+        return list(self.iter_results())
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,88 @@
+import os
+import json
+import sqlite3
+
+task_attribute_names = ["description", "challenges", "latent_techniques"]
+technique_attribute_names = ["description", "advantages", "disadvantages", "targeted_tasks", "project_urls"]
+
+def normalize_name(name):
+    return " ".join(str(name).split()).casefold()
+
+
+class KnowledgeStore:
+    # SQLite store of extracted tasks and techniques keyed by (kind, normalized name),
+    # every attribute kept as a set of values, so merging a new extraction only
+    # touches its own rows; task.json and technique.json are exported from it
+    def __init__(self, db_path="./extract_infomation/knowledge.sqlite"):
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS entities (
+                kind TEXT,
+                norm_name TEXT,
+                name TEXT,
+                PRIMARY KEY (kind, norm_name)
+            );
+            CREATE TABLE IF NOT EXISTS attributes (
+                kind TEXT,
+                norm_name TEXT,
+                attribute TEXT,
+                value TEXT,
+                PRIMARY KEY (kind, norm_name, attribute, value)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS ingested (
+                source TEXT,
+                key TEXT,
+                hash TEXT,
+                PRIMARY KEY (source, key)
+            );
+        ''')
+
+    def upsert(self, kind, entity, attribute_names):
+        if not isinstance(entity, dict) or not entity.get("name"):
+            return
+        norm_name = normalize_name(entity["name"])
+        self.conn.execute(
+            "INSERT OR IGNORE INTO entities VALUES (?, ?, ?)",
+            (kind, norm_name, entity["name"])
+        )
+        rows = []
+        for attribute_name in attribute_names:
+            values = entity.get(attribute_name, [])
+            if not isinstance(values, list):
+                values = [values]
+            for value in values:
+                rows.append((kind, norm_name, attribute_name, json.dumps(value, ensure_ascii=False, sort_keys=True)))
+        self.conn.executemany("INSERT OR IGNORE INTO attributes VALUES (?, ?, ?, ?)", rows)
+
+    def is_ingested(self, source, key, content_hash):
+        rows = self.conn.execute(
+            "SELECT hash FROM ingested WHERE source = ? AND key = ?", (source, key)
+        ).fetchall()
+        return bool(rows) and rows[0][0] == content_hash
+
+    def mark_ingested(self, source, key, content_hash):
+        self.conn.execute("INSERT OR REPLACE INTO ingested VALUES (?, ?, ?)", (source, key, content_hash))
+
+    def export(self, kind, attribute_names):
+        merged = {}
+        for norm_name, name in self.conn.execute(
+            "SELECT norm_name, name FROM entities WHERE kind = ? ORDER BY rowid", (kind,)
+        ):
+            merged[norm_name] = {"name": name, **{attribute_name: [] for attribute_name in attribute_names}}
+        for norm_name, attribute_name, value in self.conn.execute(
+            "SELECT norm_name, attribute, value FROM attributes WHERE kind = ?", (kind,)
+        ):
+            if norm_name in merged and attribute_name in merged[norm_name]:
+                merged[norm_name][attribute_name].append(json.loads(value))
+        return list(merged.values())
+
+    def entity_num(self, kind):
+        return self.conn.execute("SELECT COUNT(*) FROM entities WHERE kind = ?", (kind,)).fetchone()[0]
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
@@ -1,12 +1,21 @@
 import os
 import json
-from concurrent.futures import ThreadPoolExecutor
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from collections import defaultdict
 import argparse
-from util import client, extract_from_code_block, extract_json_from_str
+from util import client, async_client, extract_from_code_block, extract_json_from_str, pack_by_token_budget, repair_json, parse_or_invalidate, add_llm_arguments, apply_llm_arguments
+from journal import Journal
+from corpus import compile_corpus
+from sharding import parse_shard, shard_path
 
 os.makedirs("./logical_flow", exist_ok=True)
 
+section_journal_path = "./logical_flow/section_journal.jsonl"
+# set by use_shard, the fused frameworks are then written to <section>.shard-i-of-N.json
+logical_flow_shard = None
+fused_section_name_list = ["abstract", "introduction", "related_work", "experiment", "conclusion", "appendix"]
+
 logical_flow_prompt = '''Please read the input text, and follow these instructions:
 1. Create a new writing framework for the input text.
 2. Present the new writing framework point by point within a code block using format "```string\n<output>```", where "<output>" is a placeholder.
@@ -23,148 +32,332 @@ x. The conclusion emphasizes xxx .
 ```
 '''
 
+packed_logical_flow_prompt = '''Please read every input text in the input json, and follow these instructions for each text separately:
+1. Create a new writing framework for the text.
+2. Ensure the framework focuses exclusively on compositional patterns, ignoring specific model names, approach names, method names, datasets, numerical results, and technical jargon.
+3. Condense the writing framework into a single cohesive paragraph that lists the framework point by point.
+4. Answer with a json object that maps every key of the input json to the writing framework of its text, within a code block using format "```json\n<output>```", where "<output>" is a placeholder.
+5. An example is as follows:
+
+```json
+{
+    "1": "1. Fistly, the introduction highlights ... . 2. Then, the focus shifts to ... . x. The conclusion emphasizes xxx .",
+    "2": "1. Fistly, the abstract states ... . 2. Then, ... ."
+}
+```
+'''
+
 fusion_prompt = '''Please read the input json, and follow these instructions:
 1. Remove duplicates in input json and refine the input json for more abstract write frameworks with fewer elements.
 2. Answer should be in the format of "```json<output>```", where "<output>" is the placeholder of a list.
 '''
 
-def concatenate_values(structure):
-    result = []
-    if isinstance(structure, str):
-        result.append(structure)
-    if isinstance(structure, list):
-        if len(structure) != 0:
-            for v in structure:
-                result.append(concatenate_values(v))
-    if isinstance(structure, dict):
-        if len(structure.values()) != 0:
-            for v in structure.values():
-                result.append(concatenate_values(v))
-    result = [item for item in result if item is not None]
-    return "\n".join(result)
-
-def read_structure_data(json_path):
-    section_name_list = [
-        "title",
-        "abstract",
-        "introduction",
-        "related work",
-        "experiment",
-        "conclusion",
-        "limitation",
-        "reference",
-        "appendix",
-        "checklist",
-        "image",
-        "table",
+def build_section_messages(text):
+    global logical_flow_prompt
+    return [
+        {'role': 'system', 'content': logical_flow_prompt},
+        {'role': 'user', 'content': f'```input text\n{text}```'}
     ]
-    with open(json_path, encoding='utf-8') as f:
-        json_data = json.load(f)
-    new_json_data = dict()
-    for key in json_data['structure'].keys():
-        for sn in section_name_list:
-            if sn in key.lower():
-                new_json_data[sn] = concatenate_values(json_data['structure'][key])
-    empty_key_list = []
-    for key in new_json_data.keys():
-        value_idx_list = new_json_data[key].split("\n")
-        value_list = []
-        for idx in value_idx_list:
-            if idx != "":
-                value_list.append(json_data['data'][idx])
-        new_json_data[key] = "\n".join(value_list)
-        if new_json_data[key] == "":
-            empty_key_list.append(key)
-    for key in empty_key_list:
-        new_json_data.pop(key)
-    if "related work" in new_json_data.keys():
-        new_json_data['related_work'] = new_json_data['related work']
-        new_json_data.pop("related work")
-    return new_json_data
 
-def process_section(text):
-    global client, logical_flow_prompt
-    completion = client.chat.completions.create(
-            model="qwen-plus",
-            messages=[
-                {'role': 'system', 'content': logical_flow_prompt},
-                {'role': 'user', 'content': f'```input text\n{text}```'}
-            ],
-            stream=False,
-            temperature=0.01
-        )
-    result = completion.choices[0].message.content
+def parse_section_result(result):
     result_str_list = extract_from_code_block(result)
     result_str = result_str_list[0].strip("string\n").strip("<").strip(">")
     return result_str
 
-def fusion_logical_flow(text_list):
-    global client, fusion_prompt
-    completion = client.chat.completions.create(
-            model="qwen-plus",
-            messages=[
-                {'role': 'system', 'content': fusion_prompt},
-                {'role': 'user', 'content': f'```json\n{json.dumps(text_list)}```'}
-            ],
-            stream=False,
-            temperature=0.01
-        )
-    result = completion.choices[0].message.content
+def build_packed_section_messages(text_dict):
+    global packed_logical_flow_prompt
+    return [
+        {'role': 'system', 'content': packed_logical_flow_prompt},
+        {'role': 'user', 'content': f'```json\n{json.dumps(text_dict, ensure_ascii=False)}```'}
+    ]
+
+def parse_packed_section_result(result, key_list):
+    # raises if the answer does not hold a framework string for every key
+    result_str_list = extract_from_code_block(result)
+    result_json = repair_json(result_str_list[0])
+    return [result_json[key].strip() for key in key_list]
+
+def build_fusion_messages(text_list):
+    global fusion_prompt
+    return [
+        {'role': 'system', 'content': fusion_prompt},
+        {'role': 'user', 'content': f'```json\n{json.dumps(text_list)}```'}
+    ]
+
+def parse_fusion_result(result):
     result_str_list = extract_from_code_block(result)
     result_json = extract_json_from_str(result_str_list[0])
     return result_json
 
-def batch_generate_logical_flow(json_dir):
+def process_section(text):
+    global client
+    request = dict(model="qwen-plus", messages=build_section_messages(text), temperature=0.01)
+    completion = client.chat.completions.create(**request, stream=False, code_blocks=1)
+    result = completion.choices[0].message.content
+    return parse_or_invalidate(client.chat.completions, request, result, parse_section_result, bool)
+
+def fusion_logical_flow(text_list):
+    global client
+    request = dict(model="qwen-plus", messages=build_fusion_messages(text_list), temperature=0.01)
+    completion = client.chat.completions.create(**request, stream=False, code_blocks=1)
+    result = completion.choices[0].message.content
+    return parse_or_invalidate(client.chat.completions, request, result, parse_fusion_result)
+
+def process_sections_packed(text_list):
+    # one request for several sections, falling back to one request per
+    # section if the packed answer cannot be split back out
+    global client
+    if len(text_list) == 1:
+        return [process_section(text_list[0])]
+    key_list = [str(i + 1) for i in range(len(text_list))]
+    request = dict(model="qwen-plus", messages=build_packed_section_messages(dict(zip(key_list, text_list))), temperature=0.01)
+    try:
+        completion = client.chat.completions.create(**request, stream=False, code_blocks=1)
+        result = completion.choices[0].message.content
+        return parse_or_invalidate(client.chat.completions, request, result, lambda result: parse_packed_section_result(result, key_list), all)
+    except Exception as e:
+        print(f"packed request of {len(text_list)} sections failed, falling back to single requests: {e}")
+        return [process_section(text) for text in text_list]
+
+async def async_process_section(text):
+    global async_client
+    request = dict(model="qwen-plus", messages=build_section_messages(text), temperature=0.01)
+    completion = await async_client.chat.completions.create(**request, stream=False, code_blocks=1)
+    result = completion.choices[0].message.content
+    return parse_or_invalidate(async_client.chat.completions, request, result, parse_section_result, bool)
+
+async def async_fusion_logical_flow(text_list):
+    global async_client
+    request = dict(model="qwen-plus", messages=build_fusion_messages(text_list), temperature=0.01)
+    completion = await async_client.chat.completions.create(**request, stream=False, code_blocks=1)
+    result = completion.choices[0].message.content
+    return await asyncio.to_thread(parse_or_invalidate, async_client.chat.completions, request, result, parse_fusion_result)
+
+async def async_process_sections_packed(text_list):
+    global async_client
+    if len(text_list) == 1:
+        return [await async_process_section(text_list[0])]
+    key_list = [str(i + 1) for i in range(len(text_list))]
+    request = dict(model="qwen-plus", messages=build_packed_section_messages(dict(zip(key_list, text_list))), temperature=0.01)
+    try:
+        completion = await async_client.chat.completions.create(**request, stream=False, code_blocks=1)
+        result = completion.choices[0].message.content
+        return parse_or_invalidate(async_client.chat.completions, request, result, lambda result: parse_packed_section_result(result, key_list), all)
+    except Exception as e:
+        print(f"packed request of {len(text_list)} sections failed, falling back to single requests: {e}")
+        return list(await asyncio.gather(*[async_process_section(text) for text in text_list]))
+
+def collect_section_data(corpus, journal):
     json_data_list = []
-    for file_name in os.listdir(json_dir):
-        file_path = os.path.join(json_dir, file_name)
+    for file_name, content_hash in corpus.hashes().items():
         json_data_list.append(
-            read_structure_data(file_path)
+            (file_name, content_hash, corpus.sections(file_name))
         )
-    section_name_list = [
-        "abstract",
-        "introduction",
-        "related_work",
-        "experiment",
-        "conclusion",
-        "appendix"
-    ]
-
     input_data  = []
-    for section_name in section_name_list:
-        for json_data in json_data_list:
-            if section_name in json_data.keys():
-                input_data.append((section_name, json_data[section_name]))
+    for section_name in fused_section_name_list:
+        for file_name, content_hash, json_data in json_data_list:
+            key = f"{file_name}:{section_name}"
+            if section_name in json_data.keys() and not journal.is_done(key, content_hash):
+                input_data.append((key, content_hash, section_name, json_data[section_name]))
+    return input_data
 
+def group_section_results(journal):
     logical_flow_result = defaultdict(list)
-    with ThreadPoolExecutor(max_workers=8) as executor:
-        futures_key = {
-            executor.submit(process_section, item[1]):item[0]
-            for item in input_data
-        }
-        for future in futures_key:
-            sn = futures_key[future]
-            logical_flow_result[sn].append(future.result())
+    for result in journal.results():
+        logical_flow_result[result['section']].append(result['framework'])
+    return logical_flow_result
+
+def check_fan_in(fan_in):
+    # with fewer than 2 lists per request a level of the tree does not shrink it
+    if fan_in < 2:
+        raise ValueError(f"fan_in must be at least 2, got {fan_in}")
+    return fan_in
+
+def parse_fan_in(fan_in_str):
+    return check_fan_in(int(fan_in_str))
+
+def fusion_groups(partial_results, fan_in, fused_sections):
+    # next level of the fusion tree: every section that is not fused down to a
+    # single list yet gets its partial lists fused in groups of fan_in
+    groups = []
+    for sn, partial_list in partial_results.items():
+        if len(partial_list) == 1 and sn in fused_sections:
+            continue
+        for group_idx, start in enumerate(range(0, len(partial_list), fan_in)):
+            text_list = [text for partial in partial_list[start:start + fan_in] for text in partial]
+            groups.append((sn, group_idx, text_list))
+    return groups
+
+def update_partial_results(partial_results, fused_sections, group_results, on_section_fused=None):
+    level_results = defaultdict(dict)
+    for (sn, group_idx), result in group_results.items():
+        level_results[sn][group_idx] = result if isinstance(result, list) else [result]
+    for sn, results in level_results.items():
+        partial_results[sn] = [results[group_idx] for group_idx in sorted(results)]
+        fused_sections.add(sn)
+        if on_section_fused is not None and len(partial_results[sn]) == 1:
+            on_section_fused(sn, partial_results[sn][0])
+
+def unfused_group(sn, text_list, exc):
+    # a group whose fusion failed goes up the tree unfused, the next level fuses it along
+    print(f"fusion error for {sn}: {exc}")
+    return text_list
+
+def tree_fusion_logical_flow(logical_flow_result, fan_in=16, max_workers=8, on_section_fused=None):
+    # fuses the frameworks of every section bottom-up, fan_in lists per request,
+    # running all groups of one level in parallel until one list per section remains;
+    # on_section_fused(sn, result) is called as soon as a section is done
+    check_fan_in(fan_in)
+    partial_results = {sn: [[text] for text in text_list] for sn, text_list in logical_flow_result.items()}
+    fused_sections = set()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            groups = fusion_groups(partial_results, fan_in, fused_sections)
+            if not groups:
+                break
+            futures_key = {
+                executor.submit(fusion_logical_flow, text_list):(sn, group_idx, text_list)
+                for sn, group_idx, text_list in groups
+            }
+            group_results = {}
+            for future in as_completed(futures_key):
+                sn, group_idx, text_list = futures_key[future]
+                try:
+                    group_results[(sn, group_idx)] = future.result()
+                except Exception as exc:
+                    group_results[(sn, group_idx)] = unfused_group(sn, text_list, exc)
+            update_partial_results(partial_results, fused_sections, group_results, on_section_fused)
+    return {sn: partial_list[0] for sn, partial_list in partial_results.items()}
+
+async def async_tree_fusion_logical_flow(logical_flow_result, fan_in=16, on_section_fused=None):
+    check_fan_in(fan_in)
+    partial_results = {sn: [[text] for text in text_list] for sn, text_list in logical_flow_result.items()}
+    fused_sections = set()
+    while True:
+        groups = fusion_groups(partial_results, fan_in, fused_sections)
+        if not groups:
+            break
+        results = await asyncio.gather(*[async_fusion_logical_flow(text_list) for _, _, text_list in groups], return_exceptions=True)
+        group_results = {}
+        for (sn, group_idx, text_list), result in zip(groups, results):
+            if isinstance(result, Exception):
+                result = unfused_group(sn, text_list, result)
+            group_results[(sn, group_idx)] = result
+        update_partial_results(partial_results, fused_sections, group_results, on_section_fused)
+    return {sn: partial_list[0] for sn, partial_list in partial_results.items()}
+
+def save_section_logical_flow(sn, flow_result):
+    global logical_flow_shard
+    with open(shard_path(f"./logical_flow/{sn}.json", logical_flow_shard), 'w', encoding='utf-8') as f:
+        json.dump(flow_result, f, indent=4)
+
+def use_shard(shard):
+    global section_journal_path, logical_flow_shard
+    section_journal_path = shard_path(section_journal_path, shard)
+    logical_flow_shard = shard
+
+def merge_logical_flow_shards(shard_count, fan_in=16):
+    # the fused frameworks of every shard are fused once more per section
+    logical_flow_result = {}
+    for sn in fused_section_name_list:
+        text_list = []
+        for index in range(shard_count):
+            path = shard_path(f"./logical_flow/{sn}.json", (index, shard_count))
+            if not os.path.exists(path):
+                # a shard without papers having this section
+                continue
+            with open(path, encoding='utf-8') as f:
+                text_list.extend(json.load(f))
+        if text_list:
+            logical_flow_result[sn] = text_list
+    tree_fusion_logical_flow(logical_flow_result, fan_in, on_section_fused=save_section_logical_flow)
+
+def compact_logical_flow(fan_in=16):
+    # fuses the journaled frameworks of a previous run without regenerating them
+    global section_journal_path
+    with Journal(section_journal_path, resume=True) as journal:
+        logical_flow_result = group_section_results(journal)
+    tree_fusion_logical_flow(logical_flow_result, fan_in, on_section_fused=save_section_logical_flow)
+
+def batch_generate_logical_flow(json_dir, resume=False, corpus=None, pack_tokens=0, fan_in=16):
+    # pack_tokens > 0 packs several sections into one request up to that many input tokens
+    check_fan_in(fan_in)
+    global section_journal_path
+    if corpus is None:
+        corpus = compile_corpus(json_dir)
+    with Journal(section_journal_path, resume=resume) as journal:
+        input_data = collect_section_data(corpus, journal)
+        batches = pack_by_token_budget(input_data, pack_tokens, lambda item: item[3])
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            futures_key = {
+                executor.submit(process_sections_packed, [item[3] for item in batch]):batch
+                for batch in batches
+            }
+            for future in as_completed(futures_key):
+                batch = futures_key[future]
+                try:
+                    results = future.result()
+                except Exception as exc:
+                    # left out of the journal, so a --resume run generates them again
+                    print(f"generate error for {len(batch)} sections: {exc}")
+                    continue
+                for (key, content_hash, sn, _), result in zip(batch, results):
+                    journal.append(key, content_hash, {"section": sn, "framework": result})
+
+        logical_flow_result = group_section_results(journal)
     
-    output_flow_result = defaultdict(list)
-    with ThreadPoolExecutor(max_workers=8) as executor:
-        futures_key = {
-            executor.submit(fusion_logical_flow, logical_flow_result[sn]):sn
-            for sn in logical_flow_result
-        }
-        for future in futures_key:
-            sn = futures_key[future]
-            output_flow_result[sn].extend(future.result())
-
-    for sn in output_flow_result:
-        with open(f"./logical_flow/{sn}.json", 'w', encoding='utf-8') as f:
-            json.dump(output_flow_result[sn], f, indent=4)
+    tree_fusion_logical_flow(logical_flow_result, fan_in, on_section_fused=save_section_logical_flow)
+
+async def async_batch_generate_logical_flow(json_dir, resume=False, corpus=None, pack_tokens=0, fan_in=16):
+    check_fan_in(fan_in)
+    global section_journal_path
+    if corpus is None:
+        corpus = compile_corpus(json_dir)
+    with Journal(section_journal_path, resume=resume) as journal:
+        input_data = collect_section_data(corpus, journal)
+        batches = pack_by_token_budget(input_data, pack_tokens, lambda item: item[3])
+
+        async def process_and_journal(batch):
+            try:
+                results = await async_process_sections_packed([item[3] for item in batch])
+            except Exception as exc:
+                print(f"generate error for {len(batch)} sections: {exc}")
+                return
+            for (key, content_hash, sn, _), result in zip(batch, results):
+                journal.append(key, content_hash, {"section": sn, "framework": result})
+
+        await asyncio.gather(*[process_and_journal(batch) for batch in batches])
+        logical_flow_result = group_section_results(journal)
+
+    await async_tree_fusion_logical_flow(logical_flow_result, fan_in, on_section_fused=save_section_logical_flow)
 
 def main():
     parser = argparse.ArgumentParser(description="Generate logical flow from JSON files in a directory.")
     parser.add_argument("json_dir", type=str, help="Directory containing JSON files")
+    add_llm_arguments(parser)
+    parser.add_argument("--async_mode", action="store_true", help="Use the asyncio client instead of a thread pool")
+    parser.add_argument("--resume", action="store_true", help="Skip sections already recorded in the journal of a previous run")
+    parser.add_argument("--pack_tokens", type=int, default=0, help="Pack several sections into one request up to this many input tokens (0 disables packing)")
+    parser.add_argument("--compact_only", action="store_true", help="Fuse the journaled frameworks of a previous run without generating new ones")
+    parser.add_argument("--shard", type=parse_shard, default=None, help="Only process shard i of N (given as i/N) of the papers, with shard-local journal and outputs")
+    parser.add_argument("--merge_shards", type=int, default=None, help="Fuse the outputs of N shards into ./logical_flow/<section>.json without generating new frameworks")
+    parser.add_argument("--fan_in", type=parse_fan_in, default=16, help="Number of frameworks or partial results fused per request at each level of the fusion tree")
     args = parser.parse_args()
 
+    apply_llm_arguments(args)
+
+    if args.merge_shards is not None:
+        merge_logical_flow_shards(args.merge_shards, args.fan_in)
+        return
+
+    if args.shard is not None:
+        use_shard(args.shard)
+
+    if args.compact_only:
+        compact_logical_flow(args.fan_in)
+        return
+
     json_dir = args.json_dir
 
     if not os.path.exists(json_dir):
@@ -175,7 +368,11 @@ def main():
         print(f"Error: '{json_dir}' is not a directory.")
         return
 
-    batch_generate_logical_flow(json_dir)
+    corpus = compile_corpus(json_dir, shard=args.shard)
+    if args.async_mode:
+        asyncio.run(async_batch_generate_logical_flow(json_dir, args.resume, corpus=corpus, pack_tokens=args.pack_tokens, fan_in=args.fan_in))
+    else:
+        batch_generate_logical_flow(json_dir, args.resume, corpus=corpus, pack_tokens=args.pack_tokens, fan_in=args.fan_in)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,190 @@
+import os
+import json
+import bisect
+import threading
+
+# upper bounds in seconds of the latency histogram buckets, the last one is +Inf
+latency_buckets = [0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300]
+
+
+class LatencyHistogram:
+    def __init__(self, buckets=latency_buckets):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0.0
+        self.num = 0
+
+    def observe(self, latency):
+        self.counts[bisect.bisect_left(self.buckets, latency)] += 1
+        self.total += latency
+        self.num += 1
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the q-quantile, None for the +Inf bucket
+        if self.num == 0:
+            return None
+        rank = q * self.num
+        cumulative = 0
+        for idx, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return self.buckets[idx] if idx < len(self.buckets) else None
+        return None
+
+    def report(self):
+        return {
+            "buckets": {str(bound): count for bound, count in zip(self.buckets + ["+Inf"], self.counts)},
+            "sum": round(self.total, 3),
+            "count": self.num,
+            "mean": round(self.total / self.num, 3) if self.num else None,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+        }
+
+
+class EndpointMetrics:
+    def __init__(self):
+        self.requests = 0
+        self.errors = {}
+        self.retries = 0
+        self.hedges = 0
+        self.throttled = 0
+        self.throttle_seconds = 0.0
+        self.queue_seconds = 0.0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.latency = LatencyHistogram()
+
+    def report(self):
+        return {
+            "requests": self.requests,
+            "errors": dict(self.errors),
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "throttled": self.throttled,
+            "throttle_seconds": round(self.throttle_seconds, 3),
+            "queue_seconds": round(self.queue_seconds, 3),
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "latency": self.latency.report(),
+        }
+
+
+class CallMetrics:
+    # per-endpoint counters of the LLM calls of a run, written as a JSON report
+    # and in the Prometheus text format (e.g. for the node exporter textfile collector)
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def endpoint(self, name):
+        if name not in self.endpoints:
+            self.endpoints[name] = EndpointMetrics()
+        return self.endpoints[name]
+
+    def record_call(self, name, latency, usage=None, error=None):
+        with self.lock:
+            endpoint = self.endpoint(name)
+            endpoint.requests += 1
+            endpoint.latency.observe(latency)
+            if error is not None:
+                error_type = type(error).__name__
+                endpoint.errors[error_type] = endpoint.errors.get(error_type, 0) + 1
+            if usage is not None:
+                endpoint.prompt_tokens += getattr(usage, 'prompt_tokens', 0) or 0
+                endpoint.completion_tokens += getattr(usage, 'completion_tokens', 0) or 0
+
+    def record_retry(self, name):
+        with self.lock:
+            self.endpoint(name).retries += 1
+
+    def record_hedge(self, name):
+        with self.lock:
+            self.endpoint(name).hedges += 1
+
+    def record_throttle(self, name, seconds):
+        with self.lock:
+            endpoint = self.endpoint(name)
+            endpoint.throttled += 1
+            endpoint.throttle_seconds += seconds
+
+    def record_queue(self, name, seconds):
+        # time an async request waited for a slot of the endpoint's concurrency limit
+        with self.lock:
+            self.endpoint(name).queue_seconds += seconds
+
+    def record_cache(self, hit):
+        with self.lock:
+            if hit:
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+
+    def is_empty(self):
+        return not self.endpoints and self.cache_hits == 0
+
+    def report(self, json_parse_stats=None):
+        with self.lock:
+            return {
+                "endpoints": {name: endpoint.report() for name, endpoint in self.endpoints.items()},
+                "cache": {"hits": self.cache_hits, "misses": self.cache_misses},
+                "json_parse": dict(json_parse_stats or {}),
+            }
+
+    def prometheus_text(self, json_parse_stats=None):
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in samples:
+                label_str = ",".join(f'{key}="{label_value}"' for key, label_value in labels.items())
+                lines.append(f"{name}{{{label_str}}} {value}" if label_str else f"{name} {value}")
+
+        with self.lock:
+            endpoints = sorted(self.endpoints.items())
+            metric("llm_requests_total", "counter", "LLM requests sent per endpoint.",
+                   [({"endpoint": name}, endpoint.requests) for name, endpoint in endpoints])
+            metric("llm_errors_total", "counter", "Failed LLM requests per endpoint and error type.",
+                   [({"endpoint": name, "type": error_type}, count)
+                    for name, endpoint in endpoints for error_type, count in sorted(endpoint.errors.items())])
+            metric("llm_retries_total", "counter", "LLM requests sent again after a failure.",
+                   [({"endpoint": name}, endpoint.retries) for name, endpoint in endpoints])
+            metric("llm_hedges_total", "counter", "Duplicate LLM requests sent for a request slower than the recent p95.",
+                   [({"endpoint": name}, endpoint.hedges) for name, endpoint in endpoints])
+            metric("llm_throttled_total", "counter", "LLM requests held back by the rate governor of the endpoint.",
+                   [({"endpoint": name}, endpoint.throttled) for name, endpoint in endpoints])
+            metric("llm_throttle_seconds_total", "counter", "Seconds LLM requests waited for the quota of the endpoint.",
+                   [({"endpoint": name}, f"{endpoint.throttle_seconds:.3f}") for name, endpoint in endpoints])
+            metric("llm_queue_seconds_total", "counter", "Seconds async LLM requests waited for a concurrency slot of the endpoint.",
+                   [({"endpoint": name}, f"{endpoint.queue_seconds:.3f}") for name, endpoint in endpoints])
+            metric("llm_tokens_total", "counter", "Tokens reported in the response usage.",
+                   [({"endpoint": name, "kind": kind}, getattr(endpoint, f"{kind}_tokens"))
+                    for name, endpoint in endpoints for kind in ("prompt", "completion")])
+            lines.append("# HELP llm_request_latency_seconds LLM request latency.")
+            lines.append("# TYPE llm_request_latency_seconds histogram")
+            for name, endpoint in endpoints:
+                cumulative = 0
+                for bound, count in zip(endpoint.latency.buckets + ["+Inf"], endpoint.latency.counts):
+                    cumulative += count
+                    lines.append(f'llm_request_latency_seconds_bucket{{endpoint="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'llm_request_latency_seconds_sum{{endpoint="{name}"}} {endpoint.latency.total:.6f}')
+                lines.append(f'llm_request_latency_seconds_count{{endpoint="{name}"}} {endpoint.latency.num}')
+            metric("llm_cache_requests_total", "counter", "Response cache lookups.",
+                   [({"result": "hit"}, self.cache_hits), ({"result": "miss"}, self.cache_misses)])
+        metric("llm_json_parse_total", "counter", "Parsed model answers by the path that produced the json.",
+               [({"path": path}, count) for path, count in sorted((json_parse_stats or {}).items())])
+        return "\n".join(lines) + "\n"
+
+    def write(self, metrics_dir, json_parse_stats=None):
+        os.makedirs(metrics_dir, exist_ok=True)
+        with open(os.path.join(metrics_dir, "llm_metrics.json"), 'w', encoding='utf-8') as f:
+            json.dump(self.report(json_parse_stats), f, indent=4)
+        # written to a temporary file first, a textfile collector must never see a partial file
+        prom_path = os.path.join(metrics_dir, "llm_metrics.prom")
+        with open(prom_path + ".tmp", 'w', encoding='utf-8') as f:
+            f.write(self.prometheus_text(json_parse_stats))
+        os.replace(prom_path + ".tmp", prom_path)
@@ -0,0 +1,244 @@
+import os
+import time
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from util import add_llm_arguments, apply_llm_arguments
+from corpus import compile_corpus
+from word_index import WordIndex
+from sharding import parse_shard
+import structures_check
+import words_analysis
+import logical_flow_refine
+import extract_experiment
+import extract_task_technique
+from structures_check import collect_structure_items, review_structures, async_review_structures, rewrite_structures
+from words_analysis import dir_update_word_frequencies
+from logical_flow_refine import batch_generate_logical_flow, async_batch_generate_logical_flow
+from extract_experiment import batch_extract_experiment_infomation, async_batch_extract_experiment_infomation
+from extract_task_technique import batch_extract_task_technique_infomation, async_batch_extract_task_technique_infomation
+
+# the default stop words and current words files ship next to this script
+package_dir = os.path.dirname(os.path.abspath(__file__))
+
+# every stage waits for the selected stages it depends on, the stages whose
+# dependencies are done run concurrently on the same corpus and LLM clients
+stage_dependencies = {
+    "review": [],
+    "rewrite": ["review"],
+    "words": ["rewrite"],
+    "logical_flow": ["rewrite"],
+    "experiment": ["rewrite"],
+    "task_technique": ["rewrite"],
+}
+stage_name_list = list(stage_dependencies.keys())
+
+
+def run_review(corpus, args):
+    review_structures(collect_structure_items(corpus), resume=args.resume)
+
+async def async_run_review(corpus, args):
+    await async_review_structures(collect_structure_items(corpus), resume=args.resume)
+
+def run_rewrite(corpus, args):
+    rewrite_structures(corpus.json_dir, corpus=corpus, workers=args.workers)
+
+def run_words(corpus, args):
+    word_index = None if args.no_index else WordIndex.for_corpus(corpus)
+    try:
+        dir_update_word_frequencies(corpus.json_dir, args.stop_words_path, args.current_words_path, corpus=corpus, workers=args.workers, word_index=word_index, dump=args.dump)
+    finally:
+        if word_index is not None:
+            word_index.close()
+
+def run_logical_flow(corpus, args):
+    batch_generate_logical_flow(corpus.json_dir, args.resume, corpus=corpus, pack_tokens=args.pack_tokens, fan_in=args.fan_in)
+
+async def async_run_logical_flow(corpus, args):
+    await async_batch_generate_logical_flow(corpus.json_dir, args.resume, corpus=corpus, pack_tokens=args.pack_tokens, fan_in=args.fan_in)
+
+def run_experiment(corpus, args):
+    batch_extract_experiment_infomation(corpus.json_dir, args.resume, corpus=corpus, pack_tokens=args.pack_tokens)
+
+async def async_run_experiment(corpus, args):
+    await async_batch_extract_experiment_infomation(corpus.json_dir, args.resume, corpus=corpus, pack_tokens=args.pack_tokens)
+
+def run_task_technique(corpus, args):
+    batch_extract_task_technique_infomation(corpus.json_dir, args.resume, corpus=corpus, dedup_threshold=args.dedup_threshold)
+
+async def async_run_task_technique(corpus, args):
+    await async_batch_extract_task_technique_infomation(corpus.json_dir, args.resume, corpus=corpus, dedup_threshold=args.dedup_threshold)
+
+stage_runners = {
+    "review": run_review,
+    "rewrite": run_rewrite,
+    "words": run_words,
+    "logical_flow": run_logical_flow,
+    "experiment": run_experiment,
+    "task_technique": run_task_technique,
+}
+# stages without an async runner are run in a worker thread in async mode
+async_stage_runners = {
+    "review": async_run_review,
+    "logical_flow": async_run_logical_flow,
+    "experiment": async_run_experiment,
+    "task_technique": async_run_task_technique,
+}
+
+
+# module holding use_shard for the shard-local outputs of each stage
+stage_modules = {
+    "review": structures_check,
+    "rewrite": structures_check,
+    "words": words_analysis,
+    "logical_flow": logical_flow_refine,
+    "experiment": extract_experiment,
+    "task_technique": extract_task_technique,
+}
+stage_shard_mergers = {
+    "review": lambda shard_count, args: structures_check.merge_structures_shards(shard_count),
+    "words": lambda shard_count, args: words_analysis.merge_word_shards(shard_count),
+    "logical_flow": lambda shard_count, args: logical_flow_refine.merge_logical_flow_shards(shard_count, args.fan_in),
+    "experiment": lambda shard_count, args: extract_experiment.merge_experiment_shards(shard_count),
+    "task_technique": lambda shard_count, args: extract_task_technique.merge_task_technique_shards(shard_count, args.dedup_threshold),
+}
+
+
+def selected_dependencies(stages):
+    return {stage: [dep for dep in stage_dependencies[stage] if dep in stages] for stage in stages}
+
+def timed_stage(stage, corpus, args):
+    start_time = time.time()
+    print(f"stage {stage} started.")
+    stage_runners[stage](corpus, args)
+    print(f"stage {stage} finished in {time.time() - start_time:.1f}s.")
+
+async def async_timed_stage(stage, corpus, args):
+    start_time = time.time()
+    print(f"stage {stage} started.")
+    if stage in async_stage_runners:
+        await async_stage_runners[stage](corpus, args)
+    else:
+        await asyncio.to_thread(stage_runners[stage], corpus, args)
+    print(f"stage {stage} finished in {time.time() - start_time:.1f}s.")
+
+def run_stages(corpus, stages, args):
+    # a failed stage only skips the stages depending on it
+    dependencies = selected_dependencies(stages)
+    pending = list(stages)
+    done, failed = set(), set()
+    with ThreadPoolExecutor(max_workers=len(stages)) as executor:
+        running = {}
+        while pending or running:
+            for stage in list(pending):
+                if any(dep in failed for dep in dependencies[stage]):
+                    print(f"stage {stage} skipped, a dependency failed.")
+                    pending.remove(stage)
+                    failed.add(stage)
+                elif all(dep in done for dep in dependencies[stage]):
+                    pending.remove(stage)
+                    running[executor.submit(timed_stage, stage, corpus, args)] = stage
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                try:
+                    future.result()
+                    done.add(stage)
+                except Exception as exc:
+                    print(f"stage {stage} error: {exc}")
+                    failed.add(stage)
+    return done
+
+async def async_run_stages(corpus, stages, args):
+    dependencies = selected_dependencies(stages)
+    tasks = {}
+    done = set()
+
+    async def run_after_dependencies(stage):
+        for dep in dependencies[stage]:
+            try:
+                await tasks[dep]
+            except Exception:
+                print(f"stage {stage} skipped, a dependency failed.")
+                raise
+        try:
+            await async_timed_stage(stage, corpus, args)
+        except Exception as exc:
+            print(f"stage {stage} error: {exc}")
+            raise
+        done.add(stage)
+
+    for stage in stages:
+        tasks[stage] = asyncio.ensure_future(run_after_dependencies(stage))
+    await asyncio.gather(*tasks.values(), return_exceptions=True)
+    return done
+
+def merge_shards(stages, shard_count, args):
+    for module in set(stage_modules.values()):
+        module.use_shard(None)
+    for stage in stage_name_list:
+        if stage in stages and stage in stage_shard_mergers:
+            stage_shard_mergers[stage](shard_count, args)
+
+def run_pipeline(json_dir, stages, args, async_mode=False, shard=None):
+    stages = [stage for stage in stage_name_list if stage in stages]
+    for module in set(stage_modules.values()):
+        module.use_shard(shard)
+    corpus = compile_corpus(json_dir, shard=shard)
+    try:
+        if async_mode:
+            done = asyncio.run(async_run_stages(corpus, stages, args))
+        else:
+            done = run_stages(corpus, stages, args)
+    finally:
+        corpus.close()
+    print(f"pipeline: {len(done)} of {len(stages)} stages completed.")
+    return done
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the processing stages as one dependency graph over a shared corpus.")
+    parser.add_argument("json_dir", type=str, help="Directory containing JSON files")
+    parser.add_argument("--stages", type=str, default=",".join(stage_name_list), help=f"Comma separated stages to run, from {', '.join(stage_name_list)}")
+    add_llm_arguments(parser)
+    parser.add_argument("--async_mode", action="store_true", help="Run the stages and their requests on one asyncio event loop instead of thread pools")
+    parser.add_argument("--resume", action="store_true", help="Skip items already recorded in the journals of a previous run")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of worker processes counting words and rewriting structures")
+    parser.add_argument("--no_index", action="store_true", help="Recount every file instead of using the persisted word index")
+    parser.add_argument("--stop_words_path", type=str, default=os.path.join(package_dir, "stop_words_english.txt"), help="Path to the stop words file, the one next to this script by default")
+    parser.add_argument("--current_words_path", type=str, default=os.path.join(package_dir, "current_words.txt"), help="Path to the current words file, the one next to this script by default")
+    parser.add_argument("--dump", action="store_true", help="Write ./word_frequencies.json and the ./new_words_diff.txt diff")
+    parser.add_argument("--pack_tokens", type=int, default=0, help="Pack several sections into one logical flow or experiment request up to this many input tokens")
+    parser.add_argument("--fan_in", type=logical_flow_refine.parse_fan_in, default=16, help="Number of frameworks fused per request at each level of the fusion tree")
+    parser.add_argument("--shard", type=parse_shard, default=None, help="Only process shard i of N (given as i/N) of the papers, with shard-local outputs")
+    parser.add_argument("--merge_shards", type=int, default=None, help="Merge the outputs of N shards for the selected stages instead of running them")
+    parser.add_argument("--dedup_threshold", type=float, default=None, help="Consolidate near-duplicate tasks and techniques at this MinHash similarity")
+    args = parser.parse_args()
+
+    stages = [stage.strip() for stage in args.stages.split(",") if stage.strip()]
+    unknown = [stage for stage in stages if stage not in stage_dependencies]
+    if unknown:
+        print(f"Error: unknown stages {', '.join(unknown)}, choose from {', '.join(stage_name_list)}.")
+        return
+
+    # before the merge too, merging the logical flows fuses them with the LLM
+    apply_llm_arguments(args)
+
+    if args.merge_shards is not None:
+        merge_shards(stages, args.merge_shards, args)
+        return
+
+    if not os.path.isdir(args.json_dir):
+        print(f"Error: The directory '{args.json_dir}' does not exist.")
+        return
+    if "words" in stages:
+        for word_list_path in (args.stop_words_path, args.current_words_path):
+            if not os.path.exists(word_list_path):
+                print(f"Error: Word list file '{word_list_path}' does not exist.")
+                return
+
+    run_pipeline(args.json_dir, stages, args, args.async_mode, args.shard)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+import random
+import threading
+from collections import deque
+import openai
+
+# statuses a repeated request can get past: timeout, conflict, rate limit and server errors
+retryable_status_codes = {408, 409, 429}
+
+def retry_after_seconds(error):
+    # the Retry-After header of an error response in seconds, None if absent or an HTTP date
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    try:
+        return max(0.0, float(response.headers.get('retry-after')))
+    except (TypeError, ValueError):
+        return None
+
+
+def is_transient(error):
+    # the errors of the endpoint rather than of the request, see retryable_status_codes
+    if isinstance(error, openai.APIConnectionError):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in retryable_status_codes or error.status_code >= 500
+    return False
+
+
+class RetryPolicy:
+    # exponential backoff with full jitter, a Retry-After sent by the server
+    # takes precedence; only connection errors, timeouts, rate limits and
+    # server errors are retried, a bad request would fail the same way again
+    def __init__(self, max_retries=4, base_delay=1.0, max_delay=30.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def is_retryable(self, error):
+        return is_transient(error)
+
+    def delay(self, attempt, error=None):
+        retry_after = retry_after_seconds(error)
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class LatencyWindow:
+    # latencies of the recent successful requests; quantile() is None until
+    # min_samples are seen, so no request is hedged on a guess
+    def __init__(self, size=200, min_samples=20):
+        self.latencies = deque(maxlen=size)
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+
+    def observe(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def quantile(self, q):
+        with self.lock:
+            if len(self.latencies) < self.min_samples:
+                return None
+            latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
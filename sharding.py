@@ -0,0 +1,47 @@
+import os
+import re
+import hashlib
+
+# a shard is (index, count) with 0 <= index < count, papers are assigned to a
+# shard by a hash of their file name, so every node computes the same partition
+
+
+def parse_shard(shard_str):
+    # "i/N" -> (i, N)
+    try:
+        index, count = (int(part) for part in shard_str.split("/"))
+    except ValueError:
+        raise ValueError(f"shard must be given as i/N, got '{shard_str}'")
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"shard index must be in [0, {count}), got '{shard_str}'")
+    return index, count
+
+def shard_of(file_name, shard_count):
+    digest = hashlib.sha1(file_name.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % shard_count
+
+def in_shard(file_name, shard):
+    return shard is None or shard_of(file_name, shard[1]) == shard[0]
+
+def shard_suffix(shard):
+    return f"shard-{shard[0]}-of-{shard[1]}"
+
+def shard_path(path, shard):
+    # ./extract_infomation/experiment.json -> ./extract_infomation/experiment.shard-0-of-4.json,
+    # a shard suffix already in path is replaced, with shard=None it is removed
+    root, ext = os.path.splitext(path)
+    root = re.sub(r'\.shard-\d+-of-\d+$', '', root)
+    if shard is None:
+        return f"{root}{ext}"
+    return f"{root}.{shard_suffix(shard)}{ext}"
+
+def existing_shard_paths(path, shard_count):
+    # the shard-local versions of path that exist, warning about the missing ones
+    paths = []
+    for index in range(shard_count):
+        path_of_shard = shard_path(path, (index, shard_count))
+        if os.path.exists(path_of_shard):
+            paths.append(path_of_shard)
+        else:
+            print(f"Warning: '{path_of_shard}' does not exist, shard {index} is skipped.")
+    return paths
@@ -0,0 +1,95 @@
+import re
+import json
+import hashlib
+
+# papers from the same template share their heading tree and differ only in
+# the paragraph ids at its leaves: structure_shape() replaces every run of
+# leaf ids by a placeholder "@<n>", so such papers get the same shape and the
+# shape is reviewed once; fill_shape() puts each paper's ids back into the
+# reviewed shape. Heading order is kept, it is part of the paper's structure.
+
+placeholder_pattern = re.compile(r'@(\d+)')
+
+def normalize_heading(heading):
+    return " ".join(str(heading).split())
+
+def structure_shape(structure):
+    # returns (shape, leaf_groups), leaf_groups[n] is the leaf or the list of leaves behind "@n"
+    leaf_groups = []
+
+    def placeholder(leaves):
+        leaf_groups.append(leaves)
+        return f"@{len(leaf_groups) - 1}"
+
+    def visit(node):
+        if isinstance(node, dict):
+            shape = {}
+            for key, value in node.items():
+                heading = normalize_heading(key)
+                shape[heading if heading not in shape else key] = visit(value)
+            return shape
+        if isinstance(node, list):
+            if node and not any(isinstance(item, (dict, list)) for item in node):
+                return placeholder(list(node))
+            shape = []
+            run = []
+            for item in node:
+                if isinstance(item, (dict, list)):
+                    if run:
+                        shape.append(placeholder(run))
+                        run = []
+                    shape.append(visit(item))
+                else:
+                    run.append(item)
+            if run:
+                shape.append(placeholder(run))
+            return shape
+        return placeholder(node)
+
+    return visit(structure), leaf_groups
+
+def shape_key(shape):
+    return hashlib.sha256(json.dumps(shape, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def fill_shape(shape, leaf_groups):
+    # a placeholder inside a list is spliced into it, anything the review
+    # added that is not a placeholder is kept as it is
+    def leaves_of(node):
+        if isinstance(node, str):
+            match = placeholder_pattern.fullmatch(node)
+            if match and int(match.group(1)) < len(leaf_groups):
+                return leaf_groups[int(match.group(1))]
+        return None
+
+    def visit(node):
+        if isinstance(node, dict):
+            return {key: visit(value) for key, value in node.items()}
+        if isinstance(node, list):
+            filled = []
+            for item in node:
+                leaves = leaves_of(item)
+                if isinstance(leaves, list):
+                    filled.extend(leaves)
+                elif leaves is not None:
+                    filled.append(leaves)
+                else:
+                    filled.append(visit(item))
+            return filled
+        leaves = leaves_of(node)
+        if leaves is not None:
+            return list(leaves) if isinstance(leaves, list) else leaves
+        return node
+
+    return visit(shape)
+
+def group_by_shape(structure_items):
+    # structure_items are (file_name, content_hash, structure) tuples, returns
+    # {shape key: (shape, [(file_name, content_hash, leaf_groups), ...])}
+    groups = {}
+    for file_name, content_hash, structure in structure_items:
+        shape, leaf_groups = structure_shape(structure)
+        key = shape_key(shape)
+        if key not in groups:
+            groups[key] = (shape, [])
+        groups[key][1].append((file_name, content_hash, leaf_groups))
+    return groups
@@ -1,8 +1,15 @@
 import os
 import json
+import asyncio
+import multiprocessing
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import argparse
-from util import client, extract_json_from_str
+from util import client, async_client, extract_json_from_str, parse_or_invalidate, add_llm_arguments, apply_llm_arguments
+from corpus import compile_corpus
+from sharding import parse_shard, shard_path, existing_shard_paths
+from journal import Journal
+from structure_shapes import group_by_shape, fill_shape
+from heading_normalizer import HeadingNormalizer
 
 reshape_prompt = '''Please modify the structure of each dictionary in the provided list according to the following requirements:
 1. Ensure that the top-level nodes only include the following by renaming them:
@@ -25,92 +32,298 @@ reshape_prompt = '''Please modify the structure of each dictionary in the provid
 
 os.makedirs("./structures", exist_ok=True)
 
+structures_journal_path = "./structures/new_structures_journal.jsonl"
+new_structures_path = "./structures/new_structures.json"
+old_structures_path = "./structures/old_structures.json"
+heading_table_path = "./structures/heading_table.json"
 
 
-def check_json_structures(json_dir):
-    structures = []
-    json_name_list = os.listdir(json_dir)
-    for file_name in json_name_list:
-        json_path = os.path.join(json_dir, file_name)
-        with open(json_path, encoding='utf-8') as f:
-            json_data = json.load(f)
-        structures.append(json_data['structure'])
-    with open("./structures/old_structures.json", 'w', encoding='utf-8') as f:
-        json.dump(structures, f, indent=4)
 
-    review_structures(structures)
+def collect_structure_items(corpus):
+    structure_items = []
+    for file_name, content_hash in corpus.hashes().items():
+        structure_items.append((file_name, content_hash, corpus.structure(file_name)))
+    global old_structures_path
+    with open(old_structures_path, 'w', encoding='utf-8') as f:
+        json.dump([item[2] for item in structure_items], f, indent=4)
+    return structure_items
 
+def check_json_structures(json_dir, async_mode=False, corpus=None, use_rules=True, resume=False):
+    if corpus is None:
+        corpus = compile_corpus(json_dir)
+    structure_items = collect_structure_items(corpus)
 
-def process_item(client, prompt, item, idx):
-    completion = client.chat.completions.create(
+    if async_mode:
+        asyncio.run(async_review_structures(structure_items, use_rules=use_rules, resume=resume))
+    else:
+        review_structures(structure_items, use_rules=use_rules, resume=resume)
+
+
+def build_review_request(prompt, item):
+    return dict(
         model="qwen-plus",
         messages=[
             {'role': 'system', 'content': prompt},
             {'role': 'user', 'content': f'```{json.dumps(item)}```'}
         ],
-        stream=False,
         temperature=0.01
     )
 
+def process_item(client, prompt, item, idx):
+    request = build_review_request(prompt, item)
+    completion = client.chat.completions.create(**request, stream=False, code_blocks=1)
+
+    result = completion.choices[0].message.content
+    result_json = parse_or_invalidate(client.chat.completions, request, result, extract_json_from_str)
+    return result_json, idx
+
+async def async_process_item(client, prompt, item, idx):
+    request = build_review_request(prompt, item)
+    completion = await client.chat.completions.create(**request, stream=False, code_blocks=1)
+
     result = completion.choices[0].message.content
-    result_json = extract_json_from_str(result)
+    result_json = await asyncio.to_thread(parse_or_invalidate, client.chat.completions, request, result, extract_json_from_str)
     return result_json, idx
 
+def compact_new_structures():
+    # materializes new_structures.json from the journal as {file name: structure},
+    # so a paper whose review failed is missing instead of shifting the others
+    global structures_journal_path, new_structures_path
+    with Journal(structures_journal_path, resume=True) as journal:
+        results = {entry['key']: entry['result'] for entry in journal.iter_entries()}
 
-def review_structures(json_data):
-    global client, reshape_prompt
+    with open(new_structures_path, 'w', encoding='utf-8') as f:
+        json.dump(dict(sorted(results.items())), f, indent=4)
+
+def use_shard(shard):
+    # switches the journal and outputs to the shard-local ones, e.g. new_structures.shard-0-of-4.json
+    global structures_journal_path, new_structures_path, old_structures_path, heading_table_path
+    structures_journal_path = shard_path(structures_journal_path, shard)
+    new_structures_path = shard_path(new_structures_path, shard)
+    old_structures_path = shard_path(old_structures_path, shard)
+    heading_table_path = shard_path(heading_table_path, shard)
+
+def merge_structures_shards(shard_count):
+    # the shard journals are keyed by file name, so they are combined into the
+    # journal of an unsharded run, which is then compacted as usual
+    global structures_journal_path, heading_table_path
+    with Journal(structures_journal_path, resume=True) as journal:
+        for path in existing_shard_paths(structures_journal_path, shard_count):
+            with Journal(path, resume=True) as shard_journal:
+                for entry in shard_journal.iter_entries():
+                    journal.append(entry['key'], entry['hash'], entry['result'])
+    compact_new_structures()
+
+    normalizer = HeadingNormalizer(heading_table_path)
+    for path in existing_shard_paths(heading_table_path, shard_count):
+        normalizer.merge(HeadingNormalizer(path))
+    normalizer.save()
+
+
+def load_heading_normalizer():
+    # a shard starts from the merged table
+    global heading_table_path
+    normalizer = HeadingNormalizer(heading_table_path)
+    merged_table_path = shard_path(heading_table_path, None)
+    if not os.path.exists(heading_table_path) and os.path.exists(merged_table_path):
+        normalizer.merge(HeadingNormalizer(merged_table_path))
+    return normalizer
+
+def normalize_by_rules(normalizer, journal, structure_items):
+    # journals the structures whose headings are all mapped by the normalizer,
+    # returns the ones left for the LLM review
+    unmapped_items = []
+    for file_name, content_hash, structure in structure_items:
+        normalized = normalizer.normalize(structure)
+        if normalized is None:
+            unmapped_items.append((file_name, content_hash, structure))
+        else:
+            journal.append(file_name, content_hash, normalized)
+    print(f"normalized {len(structure_items) - len(unmapped_items)} of {len(structure_items)} structures by rules.")
+    return unmapped_items
+
+
+def journal_shape_review(journal, data, members):
+    # every paper of the shape gets the reviewed shape filled with its own leaf ids
+    if data is None:
+        return
+    for file_name, content_hash, leaf_groups in members:
+        journal.append(file_name, content_hash, fill_shape(data, leaf_groups))
+
+def review_structures(structure_items, compact=True, use_rules=True, resume=False):
+    # structure_items are (file_name, content_hash, structure) tuples, the
+    # structures the heading normalizer maps completely skip the LLM, of the
+    # others only one structure per shape (see structure_shapes.py) is sent for review
+    # with resume, papers journaled by a previous run with their current content are skipped
+    global client, reshape_prompt, structures_journal_path
+    normalizer = load_heading_normalizer() if use_rules else None
     
-    results = []
-    with ThreadPoolExecutor(max_workers=4) as executor:
-        futures = {executor.submit(process_item, client, reshape_prompt, item,idx): item for idx, item in enumerate(json_data)}
+    with Journal(structures_journal_path, resume=resume) as journal, ThreadPoolExecutor(max_workers=4) as executor:
+        structure_items = [item for item in structure_items if not journal.is_done(item[0], item[1])]
+        if normalizer is not None:
+            structure_items = normalize_by_rules(normalizer, journal, structure_items)
+        shape_groups = group_by_shape(structure_items)
+        print(f"reviewing {len(shape_groups)} unique shapes of {len(structure_items)} structures.")
+        futures = [
+            executor.submit(process_item, client, reshape_prompt, shape, key)
+            for key, (shape, _) in shape_groups.items()
+        ]
         
         for future in as_completed(futures):
             try:
-                data, idx = future.result()
-                if data is not None:
-                    results.append((data, idx))
+                data, key = future.result()
+                journal_shape_review(journal, data, shape_groups[key][1])
             except Exception as exc:
                 print(f'generate error: {exc}')
     
-    results.sort(key=lambda x: x[1])
-    sorted_results = [item[0] for item in results]
+    if compact:
+        compact_new_structures()
 
-    with open("./structures/new_structures.json", 'w', encoding='utf-8') as f:
-        json.dump(sorted_results, f, indent=4)
+async def async_review_structures(structure_items, compact=True, use_rules=True, resume=False):
+    global async_client, reshape_prompt, structures_journal_path
+    normalizer = load_heading_normalizer() if use_rules else None
 
-def rewrite_structures(json_dir, new_structure_path="./structures/new_structures.json"):
-    json_file_path_list = [ os.path.join(json_dir, file_name) for file_name in os.listdir(json_dir)]
-    with open(new_structure_path, encoding='utf-8') as f:
-        new_structure_list = json.load(f)
-    for file_path, structure in zip(json_file_path_list, new_structure_list):
+    with Journal(structures_journal_path, resume=resume) as journal:
+        structure_items = [item for item in structure_items if not journal.is_done(item[0], item[1])]
+        if normalizer is not None:
+            structure_items = normalize_by_rules(normalizer, journal, structure_items)
+        shape_groups = group_by_shape(structure_items)
+        print(f"reviewing {len(shape_groups)} unique shapes of {len(structure_items)} structures.")
+
+        async def review_and_journal(key, shape, members):
+            try:
+                data, _ = await async_process_item(async_client, reshape_prompt, shape, key)
+                journal_shape_review(journal, data, members)
+            except Exception as exc:
+                print(f'generate error: {exc}')
+
+        await asyncio.gather(*[review_and_journal(key, shape, members) for key, (shape, members) in shape_groups.items()])
+
+    if compact:
+        compact_new_structures()
+
+def rewrite_structure_file(file_path, structure, indent=None):
+    # runs in a worker process; the file is replaced atomically, so an
+    # interrupted rewrite leaves either the old or the new paper behind
+    temp_path = f"{file_path}.tmp"
+    try:
         with open(file_path, encoding='utf-8') as f:
             json_data = json.load(f)
         json_data['structure'] = structure
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(json_data, f, indent=4)
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(json_data, f, indent=indent)
+        os.replace(temp_path, file_path)
+        return file_path, None
+    except Exception as e:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return file_path, str(e)
+
+def load_new_structures(new_structure_path):
+    with open(new_structure_path, encoding='utf-8') as f:
+        new_structures = json.load(f)
+    if isinstance(new_structures, list):
+        # the list written before new_structures.json was keyed follows the
+        # os.listdir order of the reviewed run, which cannot be recovered
+        raise ValueError(f"'{new_structure_path}' is a list of structures without file names, run 'review' again to write it keyed by file name")
+    return new_structures
+
+def learn_headings(accepted):
+    # the heading normalizer learns from the reviews accepted by the rewrite,
+    # except the ones it would have produced itself, they would only confirm its own guesses
+    normalizer = load_heading_normalizer()
+    learned_num = 0
+    for structure, reviewed_structure in accepted:
+        if normalizer.normalize(structure) != reviewed_structure:
+            normalizer.learn(structure, reviewed_structure)
+            learned_num += 1
+    normalizer.save()
+    print(f"heading table learned from {learned_num} accepted reviews.")
+
+def rewrite_structures(json_dir, new_structure_path=None, corpus=None, workers=1, indent=None, use_rules=True):
+    # writes the reviewed structures into their papers by file name, skipping
+    # papers that are gone or whose structure is already the reviewed one
+    global new_structures_path
+    new_structure_path = new_structure_path or new_structures_path
+    if corpus is None:
+        corpus = compile_corpus(json_dir)
+    new_structures = load_new_structures(new_structure_path)
+
+    tasks = []
+    current_structures = {}
+    for file_name, structure in new_structures.items():
+        current_structure = corpus.structure(file_name)
+        if current_structure is None:
+            print(f"Warning: '{file_name}' is not in the corpus, its structure is not rewritten.")
+        elif current_structure != structure:
+            file_path = os.path.join(json_dir, file_name)
+            tasks.append((file_path, structure, indent))
+            current_structures[file_path] = current_structure
+    print(f"rewriting {len(tasks)} of {len(new_structures)} structures, the others are unchanged.")
+
+    if workers <= 1 or len(tasks) <= 1:
+        results = [rewrite_structure_file(*task) for task in tasks]
+    else:
+        # spawned for the same reason as the word counting pool in words_analysis.py
+        with multiprocessing.get_context("spawn").Pool(processes=workers) as pool:
+            results = pool.starmap(rewrite_structure_file, tasks, chunksize=max(1, len(tasks) // (workers * 4)))
+    accepted = []
+    for (file_path, error), (_, structure, _) in zip(results, tasks):
+        if error is not None:
+            print(f"Error: failed to rewrite '{file_path}': {error}")
+        else:
+            accepted.append((current_structures[file_path], structure))
+    if use_rules and accepted:
+        learn_headings(accepted)
+    corpus.refresh()
 
 
 
 def main():
     parser = argparse.ArgumentParser(description="Process JSON structures.")
-    parser.add_argument('command', choices=['review', 'rewrite'], help="Command to execute: 'review' or 'rewrite'.")
+    parser.add_argument('command', choices=['review', 'rewrite', 'merge'], help="Command to execute: 'review', 'rewrite' or 'merge' (the reviews of --merge_shards shards).")
     parser.add_argument('json_dir', type=str, help="Directory containing JSON files.")
+    add_llm_arguments(parser)
+    parser.add_argument('--async_mode', action='store_true', help="Use the asyncio client instead of a thread pool.")
+    parser.add_argument('--resume', action='store_true', help="Keep the review journal of a previous run and only review papers that are new or have changed since.")
+    parser.add_argument('--shard', type=parse_shard, default=None, help="Only process shard i of N (given as i/N) of the papers, with shard-local journal and outputs.")
+    parser.add_argument('--merge_shards', type=int, default=None, help="Number of shards whose reviews the merge command combines.")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Number of worker processes rewriting files.")
+    parser.add_argument('--indent', type=int, default=None, help="Indent the rewritten JSON files, they are written compactly by default.")
+    parser.add_argument('--no_rules', action='store_true', help="Send every structure to the LLM instead of normalizing the ones with known headings locally, and do not learn headings on rewrite.")
     
     args = parser.parse_args()
 
+    apply_llm_arguments(args)
+
+    if args.command == 'merge':
+        if args.merge_shards is None:
+            print("Error: the merge command needs --merge_shards N.")
+            return
+
+        merge_structures_shards(args.merge_shards)
+        return
+
+    if args.shard is not None:
+        use_shard(args.shard)
+
     if args.command == 'review':
         if not os.path.exists(args.json_dir):
             print(f"Error: Directory '{args.json_dir}' does not exist.")
             return
         
-        check_json_structures(args.json_dir)
+        check_json_structures(args.json_dir, args.async_mode, corpus=compile_corpus(args.json_dir, shard=args.shard), use_rules=not args.no_rules, resume=args.resume)
 
     elif args.command == 'rewrite':
         if not os.path.exists(args.json_dir):
             print(f"Error: Directory '{args.json_dir}' does not exist.")
             return
 
-        rewrite_structures(args.json_dir)
+        try:
+            rewrite_structures(args.json_dir, corpus=compile_corpus(args.json_dir, shard=args.shard), workers=args.workers, indent=args.indent, use_rules=not args.no_rules)
+        except ValueError as e:
+            print(f"Error: {e}")
+            return
         print("Rewrite completed. JSON files in the directory have been updated.")
 
 if __name__ == "__main__":
@@ -1,52 +1,727 @@
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
+from openai.types.chat import ChatCompletion
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed
 import threading
+import asyncio
+import hashlib
+import time
 import os
 import re
 import json
+import atexit
+from urllib.parse import urlparse
+from metrics import CallMetrics
+from retry import RetryPolicy, LatencyWindow, retry_after_seconds, is_transient
+from governor import RateGovernor
+
+def load_config_list():
+    # LLM_CONFIG_PATH may point to a json list of {"api_key", "base_url", "model"}
+    # endpoints replacing the default ones, e.g. a local mock server for benchmarks;
+    # an endpoint may also set its "rpm" and "tpm" quota
+    config_path = os.environ.get("LLM_CONFIG_PATH")
+    if config_path:
+        with open(config_path, encoding='utf-8') as f:
+            return json.load(f)
+    return [
+        {"api_key": os.environ["DEEPSEEK_API_KEY"], "base_url": "https://api.deepseek.com", "model": "deepseek-chat"},
+        {"api_key": os.environ['BAILIAN_API_KEY'], "base_url": "https://dashscope.aliyuncs.com/compatible-mode/v1", "model": "deepseek-v3"}
+    ]
+
+config_list = load_config_list()
+
+call_metrics = CallMetrics()
+
+def endpoint_name(base_url, model):
+    return f"{model}@{urlparse(str(base_url)).hostname}"
+
+class EndpointStats:
+    # load and health of one endpoint: requests in flight, EWMA of latency and
+    # error rate, and a circuit breaker that opens after repeated failures
+    def __init__(self, alpha=0.2, failure_threshold=5, cooldown=30):
+        self.alpha = alpha
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.ewma_latency = None
+        self.error_rate = 0.0
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+
+    def start(self):
+        with self.lock:
+            self.in_flight += 1
+        return time.monotonic()
+
+    def finish(self, start_time, error=False):
+        latency = time.monotonic() - start_time
+        with self.lock:
+            self.in_flight -= 1
+            self.error_rate = (1 - self.alpha) * self.error_rate + self.alpha * (1.0 if error else 0.0)
+            if error:
+                self.consecutive_failures += 1
+                if self.consecutive_failures >= self.failure_threshold:
+                    self.open_until = time.monotonic() + self.cooldown
+                    print(f"circuit opened for {self.cooldown}s after {self.consecutive_failures} consecutive failures")
+                return latency
+            self.consecutive_failures = 0
+            self.open_until = 0.0
+            if self.ewma_latency is None:
+                self.ewma_latency = latency
+            else:
+                self.ewma_latency = (1 - self.alpha) * self.ewma_latency + self.alpha * latency
+        return latency
+
+    def cancel(self):
+        # a request cut off by the caller, e.g. a losing hedge, says nothing about the endpoint
+        with self.lock:
+            self.in_flight -= 1
+
+    def is_available(self, now):
+        return self.consecutive_failures < self.failure_threshold or now >= self.open_until
+
+    def claim(self, now):
+        # called on the endpoint chosen for a request; half-open once the
+        # cooldown has passed, the first claim takes the single probe by
+        # pushing open_until out again, so a lost probe is retried a cooldown later
+        with self.lock:
+            if self.consecutive_failures < self.failure_threshold:
+                return True
+            if now < self.open_until:
+                return False
+            self.open_until = now + self.cooldown
+            return True
+
+    def score(self, default_latency):
+        latency = self.ewma_latency if self.ewma_latency is not None else default_latency
+        return (self.in_flight + 1) * latency * (1 + 4 * self.error_rate)
+
+
+def select_least_loaded(api_list):
+    known_latency = [api.stats.ewma_latency for api in api_list if api.stats.ewma_latency is not None]
+    default_latency = min(known_latency) if known_latency else 1.0
+    while True:
+        now = time.monotonic()
+        available = [api for api in api_list if api.stats.is_available(now)]
+        if not available:
+            # every circuit is open: rather than fail the request, send it right
+            # away to the one that recovers first, a failure keeps its circuit open
+            return min(api_list, key=lambda api: api.stats.open_until)
+        # an endpoint out of quota is only chosen if it is still the fastest after its wait
+        api = min(available, key=lambda api: api.stats.score(default_latency) + api.governor.pending_wait())
+        # another thread may have taken the probe of a half-open endpoint since is_available
+        if api.stats.claim(now):
+            return api
+
+
+endpoint_governors = {}
+endpoint_governors_lock = threading.Lock()
+
+def endpoint_governor(name, rpm=None, tpm=None):
+    # the sync and the async wrapper of an endpoint share its quota
+    with endpoint_governors_lock:
+        if name not in endpoint_governors:
+            endpoint_governors[name] = RateGovernor(rpm, tpm)
+        return endpoint_governors[name]
+
+def estimate_messages_tokens(messages):
+    return sum(estimate_tokens(str(message.get('content') or "")) for message in messages or [])
+
+def usage_tokens(completion):
+    usage = getattr(completion, 'usage', None)
+    return getattr(usage, 'total_tokens', None) if usage is not None else None
+
+def is_rate_limited(error):
+    return getattr(error, 'status_code', None) == 429
+
+
+class CodeBlockTracker:
+    # accumulates streamed content and tells when code_blocks ``` blocks are closed
+    def __init__(self, code_blocks):
+        self.code_blocks = code_blocks
+        self.content = ""
+        self.scan_pos = 0
+        self.fence_num = 0
+        self.completion_id = None
+        self.finish_reason = None
+        self.usage = None
+
+    def feed(self, chunk):
+        self.completion_id = self.completion_id or chunk.id
+        if getattr(chunk, 'usage', None):
+            self.usage = chunk.usage.model_dump()
+        if not chunk.choices:
+            return False
+        choice = chunk.choices[0]
+        if choice.finish_reason:
+            self.finish_reason = choice.finish_reason
+        if choice.delta.content:
+            self.content += choice.delta.content
+            while True:
+                fence_idx = self.content.find("```", self.scan_pos)
+                if fence_idx == -1:
+                    break
+                self.fence_num += 1
+                self.scan_pos = fence_idx + 3
+            # a fence may be split across chunks, rescan the last two characters next time
+            self.scan_pos = max(self.scan_pos, len(self.content) - 2)
+        return self.fence_num >= 2 * self.code_blocks
+
+    def completion(self, model):
+        return ChatCompletion.model_validate({
+            "id": self.completion_id or "streamed",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "finish_reason": self.finish_reason or "stop",
+                "message": {"role": "assistant", "content": self.content}
+            }],
+            "usage": self.usage
+        })
 
-config_list = [
-    {"api_key": os.environ["DEEPSEEK_API_KEY"], "base_url": "https://api.deepseek.com", "model": "deepseek-chat"},
-    {"api_key": os.environ['BAILIAN_API_KEY'], "base_url": "https://dashscope.aliyuncs.com/compatible-mode/v1", "model": "deepseek-v3"}
-]
 
 class APIWrapper:
-    def __init__(self, api_key, base_url, model):
-        self.client = OpenAI(api_key=api_key, base_url=base_url)
+    def __init__(self, api_key, base_url, model, rpm=None, tpm=None, latency_window=None):
+        # retries are left to the CompletionsWrapper, which can move them to another endpoint
+        self.client = OpenAI(api_key=api_key, base_url=base_url, max_retries=0)
         self.model = model
+        self.name = endpoint_name(base_url, model)
+        self.stats = EndpointStats()
+        self.governor = endpoint_governor(self.name, rpm, tpm)
+        self.stream_code_blocks = False
+        # the hedge threshold of the CompletionsWrapper, fed with the time of the call alone
+        self.latency_window = latency_window
     
     def create(self, *args, **kwargs):
-        print(f"you are using {self.model}")
         kwargs.pop('model', None)
-        return self.client.chat.completions.create(model=self.model, *args, **kwargs)
+        # code_blocks=N: the caller only needs the first N code blocks of the answer,
+        # in streaming mode the answer is cut off as soon as they are closed
+        code_blocks = kwargs.pop('code_blocks', None)
+        estimated_tokens = estimate_messages_tokens(kwargs.get('messages'))
+        wait = self.governor.reserve(estimated_tokens)
+        if wait > 0:
+            call_metrics.record_throttle(self.name, wait)
+            time.sleep(wait)
+        start_time = self.stats.start()
+        try:
+            if code_blocks and self.stream_code_blocks and not kwargs.get('stream', False):
+                completion = self.create_streamed(code_blocks, *args, **kwargs)
+            else:
+                completion = self.client.chat.completions.create(model=self.model, *args, **kwargs)
+        except Exception as e:
+            self.governor.settle(estimated_tokens, 0)
+            if is_rate_limited(e):
+                self.governor.pause(retry_after_seconds(e) or 1.0)
+            # only a transient error counts against the endpoint, a bad request is the caller's
+            call_metrics.record_call(self.name, self.stats.finish(start_time, error=is_transient(e)), error=e)
+            raise
+        self.governor.settle(estimated_tokens, usage_tokens(completion))
+        latency = self.stats.finish(start_time)
+        if self.latency_window is not None:
+            self.latency_window.observe(latency)
+        call_metrics.record_call(self.name, latency, completion.usage)
+        return completion
+
+    def create_streamed(self, code_blocks, *args, **kwargs):
+        kwargs['stream'] = True
+        tracker = CodeBlockTracker(code_blocks)
+        stream = self.client.chat.completions.create(model=self.model, *args, **kwargs)
+        try:
+            for chunk in stream:
+                if tracker.feed(chunk):
+                    break
+        finally:
+            # closing the response aborts the generation of whatever follows the blocks
+            stream.close()
+        return tracker.completion(self.model)
          
 
+class ResponseCache:
+    # completions are stored one file per key under <cache_dir>/<key[:2]>/<key>.json,
+    # file mtime doubles as the last access time for age and size based eviction
+    def __init__(self, cache_dir, max_size=2 * 1024 ** 3, max_age=30 * 24 * 3600):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        # sized on the first put, so importing util (e.g. in every worker
+        # process of a pool) does not walk the whole cache
+        self.total_size = None
+
+    def _entry_paths(self):
+        for root, _, file_names in os.walk(self.cache_dir):
+            for file_name in file_names:
+                if file_name.endswith(".json"):
+                    yield os.path.join(root, file_name)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    @staticmethod
+    def make_key(model, messages, temperature):
+        payload = json.dumps(
+            {"model": model, "messages": messages, "temperature": temperature},
+            sort_keys=True,
+            ensure_ascii=False
+        )
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age:
+                self._remove(path)
+                return None
+            with open(path, encoding='utf-8') as f:
+                completion = ChatCompletion.model_validate_json(f.read())
+            os.utime(path)
+            return completion
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"cache entry {key} is unreadable: {e}")
+            self._remove(path)
+            return None
+
+    def put(self, key, completion):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = completion.model_dump_json()
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        with self.lock:
+            if self.total_size is None:
+                self.total_size = sum(os.path.getsize(path) for path in self._entry_paths())
+            if os.path.exists(path):
+                self.total_size -= os.path.getsize(path)
+            os.replace(tmp_path, path)
+            self.total_size += os.path.getsize(path)
+            if self.total_size > self.max_size:
+                self._evict()
+
+    def invalidate(self, key):
+        # drops the entry of an answer the caller could not use, so the next run asks again
+        self._remove(self._path(key))
+
+    def _remove(self, path):
+        with self.lock:
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+                if self.total_size is not None:
+                    self.total_size -= size
+            except FileNotFoundError:
+                pass
+
+    def _evict(self):
+        # called with self.lock held, drops expired entries first and then the
+        # least recently used ones until the cache is back under 90% of max_size
+        now = time.time()
+        entries = []
+        for path in self._entry_paths():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        self.total_size = sum(entry[1] for entry in entries)
+        for mtime, size, path in entries:
+            if self.total_size <= self.max_size * 0.9 and now - mtime <= self.max_age:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.total_size -= size
+
+    def clear(self):
+        with self.lock:
+            for path in list(self._entry_paths()):
+                os.remove(path)
+            self.total_size = 0
+
+
+def select_other_clients(client_list, exclude):
+    # a retry or hedge goes to another endpoint whenever there is one
+    return [api for api in client_list if api is not exclude] or client_list
+
+
 class CompletionsWrapper:
-    def __init__(self, config_list):
+    # routing is either "round_robin" or "least_loaded"; failed requests are
+    # retried by retry_policy, with hedging a request still running after the
+    # p95 of the recent latencies gets a duplicate on another endpoint and
+    # whichever answer comes first is used
+    def __init__(self, config_list, cache=None, routing="round_robin", retry_policy=None, hedging=False):
+        self.latency_window = LatencyWindow()
         self.client_list = [
-            APIWrapper(**config)
+            APIWrapper(**config, latency_window=self.latency_window)
             for config in config_list
         ]
         self.client_num = len(self.client_list)
         self.visit_num = 0
         self.lock = threading.Lock()
-    
-    def create(self, *args, **kwargs):
+        self.cache = cache
+        self.use_cache = cache is not None
+        self.routing = routing
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.hedging = hedging
+        self.hedge_executor = None
+
+    def select_client(self, exclude=None):
+        client_list = select_other_clients(self.client_list, exclude)
         with self.lock:
-            current_client_index = self.visit_num % self.client_num
+            if self.routing == "least_loaded":
+                return select_least_loaded(client_list)
+            current_client_index = self.visit_num % len(client_list)
             self.visit_num += 1
-        return self.client_list[current_client_index].create(*args, **kwargs)
+        return client_list[current_client_index]
+
+    def hedged_create(self, api, args, kwargs):
+        hedge_delay = self.latency_window.quantile(0.95) if self.hedging and self.client_num > 1 else None
+        if hedge_delay is None:
+            return api.create(*args, **kwargs)
+        with self.lock:
+            if self.hedge_executor is None:
+                self.hedge_executor = ThreadPoolExecutor(max_workers=128, thread_name_prefix="llm-hedge")
+        primary = self.hedge_executor.submit(api.create, *args, **kwargs)
+        if wait([primary], timeout=hedge_delay).done:
+            return primary.result()
+        backup_api = self.select_client(exclude=api)
+        call_metrics.record_hedge(backup_api.name)
+        backup = self.hedge_executor.submit(backup_api.create, *args, **kwargs)
+        # a blocking request cannot be cancelled, the slower one finishes unused
+        error = None
+        for future in as_completed([primary, backup]):
+            if future.exception() is None:
+                return future.result()
+            error = future.exception()
+        raise error
+
+    def create_with_retries(self, args, kwargs):
+        api = None
+        for attempt in range(self.retry_policy.max_retries + 1):
+            api = self.select_client(exclude=api)
+            try:
+                return self.hedged_create(api, args, kwargs)
+            except Exception as e:
+                if attempt == self.retry_policy.max_retries or not self.retry_policy.is_retryable(e):
+                    raise
+                delay = self.retry_policy.delay(attempt, e)
+                call_metrics.record_retry(api.name)
+                print(f"{api.name} request failed ({type(e).__name__}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+    
+    def invalidate(self, model=None, messages=None, temperature=None, **kwargs):
+        # takes the arguments of the create call whose answer turned out unusable
+        if self.cache is not None:
+            self.cache.invalidate(self.cache.make_key(model, messages, temperature))
+
+    def create(self, *args, **kwargs):
+        # use_cache=False bypasses the response cache for a single call
+        use_cache = kwargs.pop('use_cache', True) and self.use_cache and not kwargs.get('stream', False)
+        if use_cache:
+            cache_key = self.cache.make_key(kwargs.get('model'), kwargs.get('messages'), kwargs.get('temperature'))
+            completion = self.cache.get(cache_key)
+            call_metrics.record_cache(completion is not None)
+            if completion is not None:
+                return completion
+        completion = self.create_with_retries(args, kwargs)
+        if use_cache and completion.choices and completion.choices[0].message.content:
+            self.cache.put(cache_key, completion)
+        return completion
 
 class ChatWrapper:
-    def __init__(self, config_list):
-        self.completions = CompletionsWrapper(config_list)
+    def __init__(self, config_list, cache=None, routing="round_robin", retry_policy=None, hedging=False):
+        self.completions = CompletionsWrapper(config_list, cache=cache, routing=routing, retry_policy=retry_policy, hedging=hedging)
         self.client_num = self.completions.client_num
 
 class ClientWrapper:
-    def __init__(self, config_list, workers_per_api=1):
-        self.chat = ChatWrapper(config_list)
+    def __init__(self, config_list, workers_per_api=1, cache_dir=None, cache_max_size=2 * 1024 ** 3, cache_max_age=30 * 24 * 3600, routing="round_robin", retry_policy=None, hedging=False):
+        cache = ResponseCache(cache_dir, cache_max_size, cache_max_age) if cache_dir else None
+        self.chat = ChatWrapper(config_list, cache=cache, routing=routing, retry_policy=retry_policy, hedging=hedging)
         self.max_workers = self.chat.client_num * workers_per_api
 
-client = ClientWrapper(config_list)
+    def set_cache_enabled(self, enabled):
+        completions = self.chat.completions
+        completions.use_cache = enabled and completions.cache is not None
+
+    def set_streaming(self, enabled):
+        for api in self.chat.completions.client_list:
+            api.stream_code_blocks = enabled
+
+    def set_hedging(self, enabled):
+        self.chat.completions.hedging = enabled
+
+
+class AsyncAPIWrapper:
+    def __init__(self, api_key, base_url, model, max_concurrency=64, rpm=None, tpm=None, latency_window=None):
+        self.client = AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0)
+        self.model = model
+        self.name = endpoint_name(base_url, model)
+        self.stats = EndpointStats()
+        self.governor = endpoint_governor(self.name, rpm, tpm)
+        self.stream_code_blocks = False
+        self.latency_window = latency_window
+        self.max_concurrency = max_concurrency
+        self.semaphore = None
+        self.loop = None
+
+    def get_semaphore(self):
+        # semaphores are bound to the event loop they are first used in,
+        # so a new one is needed for every asyncio.run
+        loop = asyncio.get_running_loop()
+        if self.semaphore is None or self.loop is not loop:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+            self.loop = loop
+        return self.semaphore
+
+    async def create(self, *args, **kwargs):
+        kwargs.pop('model', None)
+        code_blocks = kwargs.pop('code_blocks', None)
+        estimated_tokens = estimate_messages_tokens(kwargs.get('messages'))
+        wait = self.governor.reserve(estimated_tokens)
+        if wait > 0:
+            call_metrics.record_throttle(self.name, wait)
+            try:
+                await asyncio.sleep(wait)
+            except asyncio.CancelledError:
+                self.governor.settle(estimated_tokens, 0)
+                raise
+        # the latency is that of the call alone, the wait for a slot is reported as queue_seconds
+        semaphore = self.get_semaphore()
+        queued_at = time.monotonic()
+        try:
+            await semaphore.acquire()
+        except asyncio.CancelledError:
+            self.governor.settle(estimated_tokens, 0)
+            raise
+        call_metrics.record_queue(self.name, time.monotonic() - queued_at)
+        start_time = self.stats.start()
+        try:
+            if code_blocks and self.stream_code_blocks and not kwargs.get('stream', False):
+                completion = await self.create_streamed(code_blocks, *args, **kwargs)
+            else:
+                completion = await self.client.chat.completions.create(model=self.model, *args, **kwargs)
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                # a cancelled request, e.g. a losing hedge, may already have used its tokens
+                self.stats.cancel()
+                raise
+            self.governor.settle(estimated_tokens, 0)
+            if is_rate_limited(e):
+                self.governor.pause(retry_after_seconds(e) or 1.0)
+            call_metrics.record_call(self.name, self.stats.finish(start_time, error=is_transient(e)), error=e)
+            raise
+        finally:
+            semaphore.release()
+        self.governor.settle(estimated_tokens, usage_tokens(completion))
+        latency = self.stats.finish(start_time)
+        if self.latency_window is not None:
+            self.latency_window.observe(latency)
+        call_metrics.record_call(self.name, latency, completion.usage)
+        return completion
+
+    async def create_streamed(self, code_blocks, *args, **kwargs):
+        kwargs['stream'] = True
+        tracker = CodeBlockTracker(code_blocks)
+        stream = await self.client.chat.completions.create(model=self.model, *args, **kwargs)
+        try:
+            async for chunk in stream:
+                if tracker.feed(chunk):
+                    break
+        finally:
+            await stream.close()
+        return tracker.completion(self.model)
+
+
+class AsyncCompletionsWrapper:
+    def __init__(self, config_list, max_concurrency=64, cache=None, routing="round_robin", retry_policy=None, hedging=False):
+        self.latency_window = LatencyWindow()
+        self.client_list = [
+            AsyncAPIWrapper(**config, max_concurrency=max_concurrency, latency_window=self.latency_window)
+            for config in config_list
+        ]
+        self.client_num = len(self.client_list)
+        self.visit_num = 0
+        self.cache = cache
+        self.use_cache = cache is not None
+        self.routing = routing
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.hedging = hedging
+        self.admission = None
+        self.loop = None
+
+    def get_admission(self):
+        # requests are admitted up to the endpoints' combined concurrency and
+        # only then routed, so a request waiting for a slot is not tied to an
+        # endpoint yet and goes to whichever is least loaded once one frees up
+        loop = asyncio.get_running_loop()
+        if self.admission is None or self.loop is not loop:
+            self.admission = asyncio.Semaphore(sum(api.max_concurrency for api in self.client_list))
+            self.loop = loop
+        return self.admission
+
+    def select_client(self, exclude=None):
+        client_list = select_other_clients(self.client_list, exclude)
+        if self.routing == "least_loaded":
+            # an admitted request goes to an endpoint with a free slot, its
+            # latency and hedge threshold then hold no wait for the semaphore
+            free_client_list = [api for api in client_list if api.stats.in_flight < api.max_concurrency]
+            return select_least_loaded(free_client_list or client_list)
+        current_client_index = self.visit_num % len(client_list)
+        self.visit_num += 1
+        return client_list[current_client_index]
+
+    async def hedged_create(self, api, args, kwargs):
+        hedge_delay = self.latency_window.quantile(0.95) if self.hedging and self.client_num > 1 else None
+        if hedge_delay is None:
+            return await api.create(*args, **kwargs)
+        pending = {asyncio.ensure_future(api.create(*args, **kwargs))}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=hedge_delay)
+            if done:
+                return done.pop().result()
+            backup_api = self.select_client(exclude=api)
+            call_metrics.record_hedge(backup_api.name)
+            pending.add(asyncio.ensure_future(backup_api.create(*args, **kwargs)))
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            # the slower request is cancelled, which also closes its connection
+            for task in pending:
+                task.cancel()
+
+    async def create_with_retries(self, args, kwargs):
+        api = None
+        for attempt in range(self.retry_policy.max_retries + 1):
+            async with self.get_admission():
+                api = self.select_client(exclude=api)
+                try:
+                    return await self.hedged_create(api, args, kwargs)
+                except Exception as e:
+                    if attempt == self.retry_policy.max_retries or not self.retry_policy.is_retryable(e):
+                        raise
+                    delay = self.retry_policy.delay(attempt, e)
+                    call_metrics.record_retry(api.name)
+                    print(f"{api.name} request failed ({type(e).__name__}), retrying in {delay:.1f}s")
+            # the backoff does not hold a slot
+            await asyncio.sleep(delay)
+
+    def invalidate(self, model=None, messages=None, temperature=None, **kwargs):
+        if self.cache is not None:
+            self.cache.invalidate(self.cache.make_key(model, messages, temperature))
+
+    async def create(self, *args, **kwargs):
+        use_cache = kwargs.pop('use_cache', True) and self.use_cache and not kwargs.get('stream', False)
+        if use_cache:
+            cache_key = self.cache.make_key(kwargs.get('model'), kwargs.get('messages'), kwargs.get('temperature'))
+            completion = self.cache.get(cache_key)
+            call_metrics.record_cache(completion is not None)
+            if completion is not None:
+                return completion
+        completion = await self.create_with_retries(args, kwargs)
+        if use_cache and completion.choices and completion.choices[0].message.content:
+            self.cache.put(cache_key, completion)
+        return completion
+
+class AsyncChatWrapper:
+    def __init__(self, config_list, max_concurrency=64, cache=None, routing="round_robin", retry_policy=None, hedging=False):
+        self.completions = AsyncCompletionsWrapper(config_list, max_concurrency=max_concurrency, cache=cache, routing=routing, retry_policy=retry_policy, hedging=hedging)
+        self.client_num = self.completions.client_num
+
+class AsyncClientWrapper:
+    def __init__(self, config_list, max_concurrency=64, cache=None, routing="round_robin", retry_policy=None, hedging=False):
+        self.chat = AsyncChatWrapper(config_list, max_concurrency=max_concurrency, cache=cache, routing=routing, retry_policy=retry_policy, hedging=hedging)
+        self.max_concurrency = max_concurrency
+
+    def set_max_concurrency(self, max_concurrency):
+        # per endpoint limit on requests in flight, takes effect for new event loops
+        # and for the current one once its semaphore is recreated
+        self.max_concurrency = max_concurrency
+        for api in self.chat.completions.client_list:
+            api.max_concurrency = max_concurrency
+            api.semaphore = None
+        self.chat.completions.admission = None
+
+    def set_cache_enabled(self, enabled):
+        completions = self.chat.completions
+        completions.use_cache = enabled and completions.cache is not None
+
+    def set_streaming(self, enabled):
+        for api in self.chat.completions.client_list:
+            api.stream_code_blocks = enabled
+
+    def set_hedging(self, enabled):
+        self.chat.completions.hedging = enabled
+
+llm_routing = os.environ.get("LLM_ROUTING", "least_loaded")
+llm_retry_policy = RetryPolicy(max_retries=int(os.environ.get("LLM_MAX_RETRIES", 4)))
+llm_hedging = bool(os.environ.get("LLM_HEDGE"))
+client = ClientWrapper(
+    config_list,
+    cache_dir=os.environ.get("LLM_CACHE_DIR", "./cache/completions"),
+    routing=llm_routing,
+    retry_policy=llm_retry_policy,
+    hedging=llm_hedging
+)
+async_client = AsyncClientWrapper(
+    config_list,
+    max_concurrency=int(os.environ.get("LLM_MAX_CONCURRENCY", 64)),
+    cache=client.chat.completions.cache,
+    routing=llm_routing,
+    retry_policy=llm_retry_policy,
+    hedging=llm_hedging
+)
+if os.environ.get("LLM_CACHE_DISABLE"):
+    client.set_cache_enabled(False)
+    async_client.set_cache_enabled(False)
+if os.environ.get("LLM_STREAM"):
+    client.set_streaming(True)
+    async_client.set_streaming(True)
+
+def add_llm_arguments(parser):
+    # the LLM client options shared by the command line scripts, see apply_llm_arguments
+    parser.add_argument("--no_cache", action="store_true", help="Bypass the on-disk LLM response cache")
+    parser.add_argument("--stream", action="store_true", help="Stream completions and stop reading once the expected code blocks are closed")
+    parser.add_argument("--hedge", action="store_true", help="Send a duplicate of a request slower than the recent p95 to another endpoint")
+    parser.add_argument("--concurrency", type=int, default=None, help="Max requests in flight per endpoint in async mode")
+
+def apply_llm_arguments(args):
+    if args.no_cache:
+        client.set_cache_enabled(False)
+        async_client.set_cache_enabled(False)
+    if args.stream:
+        client.set_streaming(True)
+        async_client.set_streaming(True)
+    if args.hedge:
+        client.set_hedging(True)
+        async_client.set_hedging(True)
+    if args.concurrency is not None:
+        async_client.set_max_concurrency(args.concurrency)
+
+def write_metrics_report(metrics_dir=None):
+    # LLM_METRICS_DIR, ./metrics by default, gets llm_metrics.json and llm_metrics.prom
+    metrics_dir = metrics_dir or os.environ.get("LLM_METRICS_DIR", "./metrics")
+    if call_metrics.is_empty():
+        return
+    with json_parse_stats_lock:
+        parse_stats = dict(json_parse_stats)
+    call_metrics.write(metrics_dir, parse_stats)
+    print(f"llm metrics written to {metrics_dir}")
+
+atexit.register(write_metrics_report)
 
 def extract_from_code_block(text):
     matches = re.findall(r'```(.*?)```', text, re.DOTALL)
@@ -60,37 +735,178 @@ def extract_from_code_block(text):
 reformat_json_prompt = '''Please convert invalid input json to valid json.
 The output should be presented within a code block in the following format: "json\n<output>", where "<output>" is the placeholder for the output.
 '''
-def reformat_json(text):
+def reformat_json(text, use_cache=True):
     global reformat_json_prompt, client
-    completion = client.chat.completions.create(
-            model="qwen-plus",
-            messages=[
-                {'role': 'system', 'content': reformat_json_prompt},
-                {'role': 'user', 'content': f'```input json\n{text}```'}
-            ],
-            stream=False,
-            temperature=0.01
-        )
+    request = dict(
+        model="qwen-plus",
+        messages=[
+            {'role': 'system', 'content': reformat_json_prompt},
+            {'role': 'user', 'content': f'```input json\n{text}```'}
+        ],
+        temperature=0.01
+    )
+    completion = client.chat.completions.create(**request, stream=False, code_blocks=1, use_cache=use_cache)
     
     result = completion.choices[0].message.content
-    new_result = extract_from_code_block(result)[0].strip("json\n").strip("<").strip(">")
-    return json.loads(new_result)
+    return parse_or_invalidate(
+        client.chat.completions, request, result,
+        lambda result: json.loads(extract_from_code_block(result)[0].strip("json\n").strip("<").strip(">"))
+    )
+
+def parse_or_invalidate(completions, request, result, parse, is_usable=lambda parsed: parsed is not None):
+    # parses the answer to the create(**request) call; an answer that does not
+    # parse or is not usable is dropped from the response cache, so a rerun
+    # asks again instead of replaying it for as long as the entry lives, and
+    # raises, so the caller leaves it out of its journal
+    try:
+        parsed = parse(result)
+    except Exception:
+        completions.invalidate(**request)
+        raise
+    if not is_usable(parsed):
+        completions.invalidate(**request)
+        raise ValueError(f"unusable answer: {str(result)[:100]!r}")
+    return parsed
 
 def reformat_json_multi_round(text, num_round=3):
+    # the retries skip the cache, it would only replay the answer that just failed
     current_round = 0
     while current_round < num_round:
         try:
-            result = reformat_json(text)
+            result = reformat_json(text, use_cache=current_round == 0)
             return result
         except Exception as e:
             print(f"{current_round} failed", e)
+            count_json_parse("llm_repair_retry")
         current_round += 1
 
+json_parse_stats = Counter()
+json_parse_stats_lock = threading.Lock()
+
+def count_json_parse(path):
+    # path is one of "direct", "local_repair", "llm_repair" or "failed",
+    # "llm_repair_retry" counts the failed rounds of the LLM repair
+    with json_parse_stats_lock:
+        json_parse_stats[path] += 1
+
+json_string_quotes = {'"': '"', "'": "'", '“': '”', '”': '”', '‘': '’', '’': '’'}
+json_closing_brackets = {'{': '}', '[': ']'}
+json_literals = {'true': 'true', 'True': 'true', 'false': 'false', 'False': 'false', 'null': 'null', 'None': 'null', 'NaN': 'null'}
+
+def strip_trailing_comma(output):
+    while output and output[-1].isspace():
+        output.pop()
+    if output and output[-1] == ',':
+        output.pop()
+
+def repair_json(text):
+    # deterministic fixes for the usual malformed LLM json: text around the
+    # value, comments, single or smart quotes, raw newlines in strings, python
+    # literals, unquoted keys, trailing commas and truncated strings/brackets
+    starts = [idx for idx in (text.find('{'), text.find('[')) if idx != -1]
+    if not starts:
+        raise ValueError("no json object or array found")
+    i = min(starts)
+    output = []
+    stack = []
+    closing_quote = None
+    while i < len(text):
+        c = text[i]
+        if closing_quote is not None:
+            if c == '\\' and i + 1 < len(text):
+                next_c = text[i + 1]
+                output.append(next_c if next_c == "'" else c + next_c)
+                i += 2
+                continue
+            if c == closing_quote:
+                output.append('"')
+                closing_quote = None
+            elif c == '"':
+                output.append('\\"')
+            elif c == '\n':
+                output.append('\\n')
+            elif c == '\t':
+                output.append('\\t')
+            else:
+                output.append(c)
+        elif c in json_string_quotes:
+            closing_quote = json_string_quotes[c]
+            output.append('"')
+        elif c in json_closing_brackets:
+            stack.append(c)
+            output.append(c)
+        elif c in '}]':
+            strip_trailing_comma(output)
+            if stack:
+                output.append(json_closing_brackets[stack.pop()])
+            if not stack:
+                break
+        elif text.startswith('//', i):
+            newline_idx = text.find('\n', i)
+            i = len(text) if newline_idx == -1 else newline_idx
+            continue
+        elif text.startswith('/*', i):
+            end_idx = text.find('*/', i + 2)
+            i = len(text) if end_idx == -1 else end_idx + 2
+            continue
+        elif (c.isalpha() or c == '_') and not text[i - 1].isdigit():
+            match = re.match(r'[A-Za-z_][A-Za-z0-9_]*', text[i:])
+            word = match.group(0) if match else c
+            output.append(json_literals.get(word, json.dumps(word)))
+            i += len(word)
+            continue
+        else:
+            output.append(c)
+        i += 1
+
+    if closing_quote is not None:
+        output.append('"')
+    if stack:
+        strip_trailing_comma(output)
+        if output and output[-1] == ':':
+            output.append('null')
+        while stack:
+            output.append(json_closing_brackets[stack.pop()])
+    return json.loads("".join(output))
+
 def extract_json_from_str(str):
     result_str = str.strip("json\n").strip("<").strip(">")
     try:
         result_json = json.loads(result_str)
+        count_json_parse("direct")
+        return result_json
     except Exception as e:
         print(f"Exception: {e}")
-        result_json = reformat_json_multi_round(result_str)
-    return result_json
\ No newline at end of file
+    try:
+        result_json = repair_json(result_str)
+        count_json_parse("local_repair")
+        return result_json
+    except Exception as e:
+        print(f"local json repair failed: {e}")
+    result_json = reformat_json_multi_round(result_str)
+    count_json_parse("llm_repair" if result_json is not None else "failed")
+    return result_json
+
+def estimate_tokens(text):
+    # rough count without a tokenizer: ~4 characters per token for English,
+    # CJK characters count as one token each
+    cjk_num = len(re.findall(r'[\u3000-\u9fff\uac00-\ud7af]', text))
+    return (len(text) - cjk_num) // 4 + cjk_num + 1
+
+def pack_by_token_budget(items, token_budget, get_text=lambda item: item):
+    # greedily groups consecutive items into batches of at most token_budget
+    # estimated tokens, an item larger than the budget gets a batch of its own
+    batches = []
+    current_batch = []
+    current_tokens = 0
+    for item in items:
+        item_tokens = estimate_tokens(get_text(item))
+        if current_batch and current_tokens + item_tokens > token_budget:
+            batches.append(current_batch)
+            current_batch = []
+            current_tokens = 0
+        current_batch.append(item)
+        current_tokens += item_tokens
+    if current_batch:
+        batches.append(current_batch)
+    return batches
@@ -0,0 +1,62 @@
+import re
+from collections import defaultdict
+
+skip_start_tokens = r"–#-&0123456789[]<:"
+skip_end_tokens = ":;?"
+skip_in_tokens = r"□θ+˜$¨´,{}|×ł“”‘’—†‡•()∈♢♣@./=_®\\/"
+skip_start_words = ["http"]
+skip_end_words = ["com"]
+
+def character_class(tokens):
+    return "[" + "".join(re.escape(token) for token in sorted(set(tokens))) + "]"
+
+def compile_skip_pattern(start_tokens=skip_start_tokens, end_tokens=skip_end_tokens, in_tokens=skip_in_tokens,
+                         start_words=skip_start_words, end_words=skip_end_words):
+    # one regex for all the start/end/in-token rules of filter_words_frequences
+    start = "|".join([character_class(start_tokens)] + [re.escape(word) for word in start_words])
+    end = "|".join([character_class(end_tokens)] + [re.escape(word) for word in end_words])
+    return re.compile(f"\\A(?:{start})|{character_class(in_tokens)}|(?:{end})\\Z")
+
+def read_word_list(path):
+    with open(path, encoding='utf-8') as f:
+        return f.read().split("\n")
+
+
+class VocabularyFilter:
+    # classifies words as "skip" (matches a token rule), "stop", "current" or "new"
+    def __init__(self, stop_words=(), current_words=(), skip_pattern=None):
+        self.stop_words = frozenset(stop_words)
+        self.current_words = frozenset(current_words)
+        self.skip_pattern = skip_pattern if skip_pattern is not None else compile_skip_pattern()
+
+    @classmethod
+    def from_files(cls, stop_words_path, current_words_path):
+        return cls(read_word_list(stop_words_path), read_word_list(current_words_path))
+
+    def is_skipped(self, word):
+        return self.skip_pattern.search(word) is not None
+
+    def classify(self, word):
+        if self.is_skipped(word):
+            return "skip"
+        if word in self.stop_words:
+            return "stop"
+        if word in self.current_words:
+            return "current"
+        return "new"
+
+    def filter_tokens(self, word_frequencies):
+        search = self.skip_pattern.search
+        return {word: count for word, count in word_frequencies.items() if search(word) is None}
+
+    def split(self, words):
+        groups = defaultdict(list)
+        for word in words:
+            groups[self.classify(word)].append(word)
+        return groups
+
+    def new_words(self, words):
+        return self.split(words)["new"]
+
+
+default_filter = VocabularyFilter()
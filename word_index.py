@@ -0,0 +1,68 @@
+import os
+import json
+import sqlite3
+
+
+class WordIndex:
+    # persisted word counts of a corpus: per-file counts keyed by the file's
+    # content hash plus the running totals over all indexed files, so a run
+    # only has to count the files that were added or changed since the last one
+    def __init__(self, db_path):
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS file_counts (
+                file_name TEXT PRIMARY KEY,
+                hash TEXT,
+                counts TEXT
+            );
+            CREATE TABLE IF NOT EXISTS word_totals (
+                word TEXT PRIMARY KEY,
+                count INTEGER
+            );
+        ''')
+
+    @classmethod
+    def for_corpus(cls, corpus):
+        return cls(os.path.splitext(corpus.db_path)[0] + ".words.sqlite")
+
+    def hashes(self):
+        return dict(self.conn.execute("SELECT file_name, hash FROM file_counts"))
+
+    def file_counts(self, file_name):
+        rows = self.conn.execute("SELECT counts FROM file_counts WHERE file_name = ?", (file_name,)).fetchall()
+        return json.loads(rows[0][0]) if rows else {}
+
+    def add_totals(self, word_frequencies, sign=1):
+        self.conn.executemany(
+            "INSERT INTO word_totals VALUES (?, ?) ON CONFLICT(word) DO UPDATE SET count = count + excluded.count",
+            [(word, sign * count) for word, count in word_frequencies.items()]
+        )
+
+    def remove_file(self, file_name):
+        self.add_totals(self.file_counts(file_name), sign=-1)
+        self.conn.execute("DELETE FROM file_counts WHERE file_name = ?", (file_name,))
+
+    def put_file(self, file_name, content_hash, word_frequencies):
+        self.remove_file(file_name)
+        self.conn.execute(
+            "INSERT INTO file_counts VALUES (?, ?, ?)",
+            (file_name, content_hash, json.dumps(word_frequencies, ensure_ascii=False))
+        )
+        self.add_totals(word_frequencies)
+
+    def commit(self):
+        self.conn.execute("DELETE FROM word_totals WHERE count <= 0")
+        self.conn.commit()
+
+    def totals(self):
+        return dict(self.conn.execute("SELECT word, count FROM word_totals"))
+
+    def clear(self):
+        self.conn.execute("DELETE FROM file_counts")
+        self.conn.execute("DELETE FROM word_totals")
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
@@ -1,8 +1,17 @@
 import json
 import re
-from collections import defaultdict
+from collections import defaultdict, Counter
+import multiprocessing
 import os
 import argparse
+from corpus import Corpus, compile_corpus
+from vocabulary import VocabularyFilter, default_filter, read_word_list
+from word_index import WordIndex
+from sharding import parse_shard, shard_path, existing_shard_paths
+
+new_words_path = "./new_words.txt"
+word_frequencies_path = "./word_frequencies.json"
+new_words_diff_path = "./new_words_diff.txt"
 
 def string_update_word_frequencies(string, word_frequencies):
     string = string.lower()
@@ -15,84 +24,158 @@ def string_update_word_frequencies(string, word_frequencies):
     
     
 
-def json_update_word_frequencies(file_path, word_frequencies):
-    with open(file_path, encoding='utf-8') as f:
-        file_data = json.load(f)
-    for value in file_data['data'].values():
-        string_update_word_frequencies(value, word_frequencies)
-
-
-def filter_words_frequences(word_frequencies):
-    skip_start_tokens = list(r"–#-&0123456789[]<:")
-    skip_end_tokens = list(":;?")
-    skip_in_tokens = list(r"□θ+˜$¨´,{}|×ł“”‘’—†‡•()∈♢♣@./=_®\\/")
-    # skip_in_tokens.extend(list("-abcdefg"))
-    new_word_frequencies = defaultdict(int)
-    for key in word_frequencies.keys():
-        skip = False
-        for token in skip_start_tokens:
-            if key.startswith(token):
-                skip = True
-                break
-        for token in skip_end_tokens:
-            if key.endswith(token):
-                skip = True
-                break
-        for token in skip_in_tokens:
-            if token in key:
-                skip = True
-                break
-        if key.endswith("com"):
-            skip = True
-        if key.startswith("http"):
-            skip = True
-        if not skip:
-            new_word_frequencies[key] = word_frequencies[key]
-    return new_word_frequencies
-
-def dir_update_word_frequencies(dir_path, stop_words_path="./stop_words_english.txt", current_words_path ="./current_words.txt"):
-    word_frequencies = defaultdict(int)
-    files_list = os.listdir(dir_path)
-    for file_path in files_list:
-        file_path = os.path.join(dir_path, file_path)
-        json_update_word_frequencies(file_path, word_frequencies)
-
-    word_frequencies = filter_words_frequences(word_frequencies)
-
-    with open(stop_words_path, encoding='utf-8') as f:
-        stop_words = f.read().split("\n")
-    
-    with open(current_words_path, encoding='utf-8') as f:
-        current_words = f.read().split('\n')
-
-    stop_words_count = 0
-    current_words_count = 0
-    new_word_frequencies = defaultdict(int)
-    for key in word_frequencies.keys():
-        if key in stop_words:
-            stop_words_count += 1
-            continue
-        if key in current_words:
-            current_words_count += 1
-            continue
-        new_word_frequencies[key] = word_frequencies[key]
-    new_word_frequencies = sorted(new_word_frequencies, key=lambda x:x[0])
+def count_shard_word_frequencies(json_dir, db_path, file_names, per_file=False):
+    # runs in a worker process, which opens its own connection to the corpus;
+    # with per_file=True the counts are returned per file name instead of merged
+    corpus = Corpus(json_dir, db_path)
+    word_frequencies = Counter()
+    file_word_frequencies = {}
+    for file_name in file_names:
+        if per_file:
+            word_frequencies = Counter()
+            file_word_frequencies[file_name] = word_frequencies
+        # the corpus keeps the data values newline-joined, which splits the same way
+        string_update_word_frequencies(corpus.text(file_name), word_frequencies)
+    corpus.close()
+    return file_word_frequencies if per_file else word_frequencies
+
+def count_word_frequencies(corpus, file_names, workers=1, per_file=False):
+    if workers <= 1 or len(file_names) <= 1:
+        return count_shard_word_frequencies(corpus.json_dir, corpus.db_path, file_names, per_file)
+
+    word_frequencies = {} if per_file else Counter()
+    # several shards per worker so that a few long papers do not leave the other workers idle
+    shard_num = min(len(file_names), workers * 4)
+    shards = [file_names[i::shard_num] for i in range(shard_num)]
+    # spawned rather than forked: the pipeline starts this pool from one of its
+    # stage threads, and a fork would copy the locks other threads are holding
+    with multiprocessing.get_context("spawn").Pool(processes=workers) as pool:
+        shard_results = pool.starmap_async(
+            count_shard_word_frequencies,
+            [(corpus.json_dir, corpus.db_path, shard, per_file) for shard in shards]
+        )
+        for shard_word_frequencies in shard_results.get():
+            word_frequencies.update(shard_word_frequencies)
+    return word_frequencies
+
+def update_word_index(corpus, word_index, workers=1):
+    corpus_hashes = corpus.hashes()
+    indexed_hashes = word_index.hashes()
+    removed_files = [file_name for file_name in indexed_hashes if file_name not in corpus_hashes]
+    for file_name in removed_files:
+        word_index.remove_file(file_name)
+    changed_files = [
+        file_name for file_name, content_hash in corpus_hashes.items()
+        if indexed_hashes.get(file_name) != content_hash
+    ]
+    file_word_frequencies = count_word_frequencies(corpus, changed_files, workers, per_file=True)
+    for file_name in changed_files:
+        word_index.put_file(file_name, corpus_hashes[file_name], file_word_frequencies[file_name])
+    word_index.commit()
+    print(f"word index updated: {len(changed_files)} files counted, {len(removed_files)} files removed.")
+    return Counter(word_index.totals())
+
+def dump_word_frequencies(word_frequencies, new_words, previous_new_words, frequencies_path=None, diff_path=None):
+    global word_frequencies_path, new_words_diff_path
+    frequencies_path = frequencies_path or word_frequencies_path
+    diff_path = diff_path or new_words_diff_path
+    with open(frequencies_path, 'w', encoding='utf-8') as f:
+        json.dump(dict(sorted(word_frequencies.items(), key=lambda x: -x[1])), f, indent=4, ensure_ascii=False)
+
+    new_words_set = set(new_words)
+    previous_new_words_set = set(previous_new_words)
+    with open(diff_path, 'w', encoding='utf-8') as f:
+        for w in new_words:
+            if w not in previous_new_words_set:
+                f.write(f"+{w}\n")
+        for w in previous_new_words:
+            if w not in new_words_set:
+                f.write(f"-{w}\n")
+
+def filter_words_frequences(word_frequencies, vocabulary_filter=default_filter):
+    return defaultdict(int, vocabulary_filter.filter_tokens(word_frequencies))
+
+def dir_update_word_frequencies(dir_path, stop_words_path="./stop_words_english.txt", current_words_path ="./current_words.txt", corpus=None, workers=1, word_index=None, dump=False):
+    global new_words_path
+    if corpus is None:
+        corpus = compile_corpus(dir_path)
+    if word_index is not None:
+        word_frequencies = update_word_index(corpus, word_index, workers)
+    else:
+        word_frequencies = count_word_frequencies(corpus, corpus.file_names(), workers)
+
+    vocabulary_filter = VocabularyFilter.from_files(stop_words_path, current_words_path)
+    word_frequencies = filter_words_frequences(word_frequencies, vocabulary_filter)
+    word_groups = vocabulary_filter.split(word_frequencies.keys())
+
+    stop_words_count = len(word_groups["stop"])
+    current_words_count = len(word_groups["current"])
+    new_word_frequencies = sorted(word_groups["new"], key=lambda x:x[0])
     new_words_count = len(new_word_frequencies)
 
     print(f"words statistics: {stop_words_count} words in stop-words, {current_words_count} words in current-words, {new_words_count} new words.")
 
-    with open("./new_words.txt", 'w', encoding='utf-8') as f:
+    if dump:
+        previous_new_words = []
+        if os.path.exists(new_words_path):
+            previous_new_words = [w for w in read_word_list(new_words_path) if w != ""]
+        dump_word_frequencies(word_frequencies, new_word_frequencies, previous_new_words)
+
+    with open(new_words_path, 'w', encoding='utf-8') as f:
         for w in new_word_frequencies:
             f.write(w+"\n")
+
+def use_shard(shard):
+    # switches the outputs to the shard-local ones, e.g. new_words.shard-0-of-4.txt
+    global new_words_path, word_frequencies_path, new_words_diff_path
+    new_words_path = shard_path(new_words_path, shard)
+    word_frequencies_path = shard_path(word_frequencies_path, shard)
+    new_words_diff_path = shard_path(new_words_diff_path, shard)
+
+def merge_word_shards(shard_count):
+    # a word is new independently of its count, so the new words of all papers
+    # are the union of the new words of the shards
+    global new_words_path, word_frequencies_path
+    new_words = {}
+    for path in existing_shard_paths(new_words_path, shard_count):
+        new_words.update((w, None) for w in read_word_list(path) if w != "")
+    new_word_list = sorted(new_words, key=lambda x: x[0])
+    with open(new_words_path, 'w', encoding='utf-8') as f:
+        for w in new_word_list:
+            f.write(w+"\n")
+
+    frequency_paths = [shard_path(word_frequencies_path, (index, shard_count)) for index in range(shard_count)]
+    frequency_paths = [path for path in frequency_paths if os.path.exists(path)]
+    if frequency_paths:
+        word_frequencies = Counter()
+        for path in frequency_paths:
+            with open(path, encoding='utf-8') as f:
+                word_frequencies.update(json.load(f))
+        with open(word_frequencies_path, 'w', encoding='utf-8') as f:
+            json.dump(dict(sorted(word_frequencies.items(), key=lambda x: -x[1])), f, indent=4, ensure_ascii=False)
+    print(f"merged shards into {len(new_word_list)} new words.")
     
 def main():
     parser = argparse.ArgumentParser(description="Word frequency analysis from JSON files in a directory.")
     parser.add_argument("dir_path", type=str, help="Directory path containing JSON files.")
     parser.add_argument("--stop_words_path", type=str, default="./stop_words_english.txt", help="Path to the stop words file.")
     parser.add_argument("--current_words_path", type=str, default="./current_words.txt", help="Path to the current words file.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of worker processes counting words.")
+    parser.add_argument("--no_index", action="store_true", help="Recount every file instead of using the persisted word index.")
+    parser.add_argument("--rebuild_index", action="store_true", help="Clear the persisted word index and recount every file into it.")
+    parser.add_argument("--shard", type=parse_shard, default=None, help="Only count shard i of N (given as i/N) of the papers, with shard-local outputs.")
+    parser.add_argument("--merge_shards", type=int, default=None, help="Merge the new words (and dumped frequencies) of N shards without counting anything.")
+    parser.add_argument("--dump", action="store_true", help="Write ./word_frequencies.json and the ./new_words_diff.txt diff against the previous new_words.txt.")
     
     args = parser.parse_args()
 
+    if args.merge_shards is not None:
+        merge_word_shards(args.merge_shards)
+        return
+
+    if args.shard is not None:
+        use_shard(args.shard)
+
     # Check if paths exist
     if not os.path.exists(args.dir_path):
         print(f"Error: Directory path '{args.dir_path}' does not exist.")
@@ -105,7 +188,13 @@ def main():
         return
 
     # Execute the function
-    dir_update_word_frequencies(args.dir_path, args.stop_words_path, args.current_words_path)
+    corpus = compile_corpus(args.dir_path, shard=args.shard)
+    word_index = None
+    if not args.no_index:
+        word_index = WordIndex.for_corpus(corpus)
+        if args.rebuild_index:
+            word_index.clear()
+    dir_update_word_frequencies(args.dir_path, args.stop_words_path, args.current_words_path, corpus=corpus, workers=args.workers, word_index=word_index, dump=args.dump)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file